@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import collections
+import numpy as np
+
+from protocol import Protocol, SensorPackage
+from communication import Client
+from sharedring import SharedSensorRing, RING_KEYS
+
+
+class Acquisition():
+	""" receive, decode and log the frames from the robot in a separate thread, so that acquisition goes on while the GUI is busy redrawing """
+	""" the worker owns /client/ and /prot/: it watches the connection state, decodes every frame as soon as it arrives, and writes the logs. the fields of /prot/ """
+	""" change with every frame decoded, so the frames sent by other threads are collected by another Protocol (see MainWindow) """
+	""" every /decimation/ frames, a snapshot of the filtered sensor data (see SensorPackage.filter) is put into /snapshots/, which the GUI empties by take(). 0 means no snapshot """
+	""" /snapshots/ is a deque: append() and popleft() are atomic, so no lock is shared with the GUI thread """
+	""" /tracer/ (a tracing.Tracer) stamps the frames from the socket to the buffer, the GUI stamps the later stages. None: not traced """
+
+	def __init__(self, client=None, prot=None, decimation=5, maxlen=1000, timeout=0.1, filepath='../log/', channels=None, logformat='bin', publishers=(), tracer=None):
+		self.client = client if client else Client(overflow='block') # lossless: while the worker waits for the log writer, TCP holds the robot back instead of frames being dropped
+		self.prot = prot if prot else Protocol()
+		self.tracer = tracer
+		if tracer:
+			self.client.tracer = self.prot.tracer = tracer
+			publishers = list(publishers) + [tracer] # the tracer follows the robot time stamps of the decoded frames
+		self.decimation = decimation
+		self.timeout = timeout # the longest wait for data, so that connection changes and close() are noticed in time
+		self.snapshots = collections.deque(maxlen=maxlen) # (frame count, filtered data). when the GUI does not take them, the oldest are dropped
+		self.connected = False
+		self.errors = 0 # how many times the worker has raised an exception
+		self.logging = { 'filepath':filepath, 'channels':channels, 'logformat':logformat } # how the SensorPackage of every connection logs, see SensorPackage
+		self.publishers = publishers # where the decoded frames are published besides, e.g. a SharedSensorRing for a GUI in another process
+
+		self.flag = True
+		self.thrd = threading.Thread(target=self.__loop, name='Acquisition', daemon=True) # daemon means the thread terminates as the main thread exits
+		self.thrd.start()
+
+	def take(self):
+		""" take out all the snapshots, oldest first. called from the GUI thread """
+		snapshots = []
+		while self.snapshots: snapshots.append(self.snapshots.popleft())
+		return snapshots
+
+	def stats(self):
+		""" the counters of the client, the protocol and the sensor package, and the snapshots waiting for the GUI, see metrics.py """
+		return { 'connected':self.connected, 'client':self.client.stats(), 'protocol':self.prot.stats(), 'sensor':self.prot.sens.stats(), 'snapshots':len(self.snapshots), 'errors':self.errors }
+
+	def close(self):
+		""" stop the worker, and write the remaining buffers to the log files """
+		if self.flag:
+			self.flag = False
+			self.thrd.join()
+			self.prot.sens.close()
+
+	def __loop(self):
+		while self.flag:
+			try:
+				self.check()
+				for publisher in self.publishers: publisher.beat(self.connected)
+				if not self.connected:
+					time.sleep(self.timeout)
+					continue
+				self.client.wait(self.timeout)
+				self.hear()
+			except Exception as ex: # the worker goes on with the next frames, otherwise logging would stop while the connection stays up
+				self.errors += 1
+				print('\nException in acquisition =', repr(ex))
+				time.sleep(self.timeout)
+
+	def check(self):
+		""" follow the connection state of the client """
+		connected = self.client.get_connection_state()
+		connection_changed = self.connected != connected
+		self.connected = connected
+
+		if connection_changed and connected:
+			self.prot.sens = SensorPackage(publishers=self.publishers, **self.logging) # if reconnected, new log files are created and old buffers are dumped
+			if self.decimation: self.prot.sens.setFilter('mean', size=5) # filtered data for the figures, updated as frames arrive
+			print("Start hearing ...")
+		elif connection_changed and not connected:
+			self.prot.sens.close() # write the remaining buffers to the log files
+			print("Hearing over. Total %i frames heard."%self.prot.cnt)
+
+	def hear(self):
+		""" decode and log every frame received, none is dumped """
+		last_cnt = self.prot.cnt
+		self.prot.distrib_many(self.client.recv_all())
+		if self.decimation and self.prot.cnt // self.decimation > last_cnt // self.decimation and not self.prot.sens.checkBufferEmpty():
+			self.snapshots.append( (self.prot.cnt, { key:np.copy(value) for key, value in self.prot.sens.filter().items() }) ) # copied, because the filters keep updating
+
+
+class SharedAcquisition():
+	""" the GUI side of an acquisition running in another process (python daemon.py serverIP --share), which publishes the frames in a SharedSensorRing """
+	""" it has the interface of Acquisition used by MainWindow: /connected/, take() and close(). either process may be restarted without the other """
+
+	def __init__(self, name='uppercomputer_sensors', filter_size=5):
+		self.name = name
+		self.filter_size = filter_size
+		self.ring = None	# mapped when the acquisition process has created it
+		self.frames = 0		# the frame counter of the ring at the last snapshot
+
+	@property
+	def connected(self):
+		return self.attach() and self.ring.is_connected()
+
+	def attach(self):
+		if not self.ring:
+			try:	self.ring = SharedSensorRing(self.name)
+			except FileNotFoundError: return False
+		return True
+
+	def take(self):
+		""" one snapshot of the newest frames if new ones have been published since the last call, averaged over /filter_size/ frames like SensorPackage.filter """
+		""" the frames are read in place from the shared memory, only their mean is computed """
+		if not self.attach(): return []
+		frames = int(self.ring.header['frames'])
+		if frames == self.frames or 0 in [ self.ring.count(key) for key, shape in RING_KEYS ]: return []
+		self.frames = frames
+		return [ (frames, self.ring.read( lambda ring: { key:np.mean( ring.bufferView(key)[-self.filter_size:], axis=0 ) for key, shape in RING_KEYS } )) ] # consistent, see SharedSensorRing.read
+
+	def stats(self):
+		""" the counters of the ring, see metrics.py. the receiving process has its own metrics """
+		if not self.attach(): return { 'connected':False }
+		return { 'connected':self.ring.is_connected(), 'frames':int(self.ring.header['frames']), 'alive':float(self.ring.header['alive']) }
+
+	def close(self):
+		if self.ring:
+			self.ring.close()
+			self.ring = None
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+import socket
+import asyncio
+import threading
+import time
+
+from communication import Framer, FrameQueue
+
+
+""" asyncio version of Server and Client in communication.py, with the same framing, heartbeat and reconnection behavior """
+""" all connections are handled in one event loop running in a separate thread. a frame is delivered as soon as it arrives: """
+""" either to /callback/ (called in the event loop thread, its answer is sent back to the sender), """
+""" or to a bounded thread-safe queue (FrameQueue) that is read by recv() / recv_all() / interact() from any thread, e.g. the GUI thread """
+
+
+class EventLoopThread():
+	""" an asyncio event loop running forever in a separate thread """
+
+	def __init__(self):
+		self.loop = asyncio.new_event_loop()
+		self.thrd = threading.Thread(target=self.loop.run_forever, daemon=True) # daemon means the thread terminates as the main thread exits
+		self.thrd.start()
+
+	def call(self, func, *args):
+		""" call /func/ in the event loop thread, from any other thread """
+		self.loop.call_soon_threadsafe(func, *args)
+
+	def run(self, coro):
+		""" run the coroutine /coro/ in the event loop thread, from any other thread. return a concurrent.futures.Future """
+		return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+loopthread = None
+
+def get_loopthread():
+	""" the event loop thread shared by all the asynchronous servers and clients, started when first needed """
+	global loopthread
+	if not loopthread: loopthread = EventLoopThread()
+	return loopthread
+
+
+class FrameProtocol(asyncio.Protocol):
+	""" one connection. raw bytes are framed by Framer, and frames are handed to /owner/ (AsyncServer or AsyncClient) """
+
+	def __init__(self, owner, checksum='sum'):
+		self.owner = owner
+		self.framer = Framer(owner.framehead, owner.heartbeat, checksum)
+		self.transport = None
+		self.address = None
+		self.last_time = time.monotonic() # time of the last receive
+		self.lost = asyncio.get_running_loop().create_future() # done when the connection is lost
+		self.I_frames = FrameQueue(owner.maxlen, owner.overflow) # frames received, when the owner has no callback
+
+	def connection_made(self, transport):
+		self.transport = transport
+		self.address = transport.get_extra_info('peername')
+		self.I_frames.resume = lambda: self.owner.loopthread.call(self.transport.resume_reading) # with the 'block' policy, reading is paused while the queue is full
+		self.owner.add(self)
+
+	def data_received(self, datastring):
+		self.last_time = time.monotonic()
+		self.framer.feed(datastring)
+		frames, beats = self.framer.decode()
+		for frame in frames: self.owner.deliver(self, frame)
+		if beats: self.owner.beat(self, beats)
+		if self.I_frames.overflow == 'block' and self.I_frames.full(): self.transport.pause_reading()
+
+	def connection_lost(self, ex):
+		if not self.lost.done(): self.lost.set_result(ex)
+		self.owner.remove(self, ex)
+
+	def write(self, datastring):
+		""" frame and send /datastring/. only call from the event loop thread """
+		if self.transport.is_closing(): return
+		if datastring == self.owner.heartbeat: self.transport.write(datastring)
+		else: self.transport.writelines(self.framer.encode_parts(datastring)) # the data are not copied into a joined frame
+
+	def close(self):
+		if self.transport: self.transport.close()
+
+	def is_silent(self, timeout):
+		""" wether nothing has been received for /timeout/ seconds. a connection paused by its full queue is not silent """
+		return time.monotonic() - self.last_time > timeout and self.transport.is_reading()
+
+
+class AsyncServer():
+	""" the server of the communication, see Server """
+
+	def __init__(self, port=8006, checksum='sum', callback=None, maxlen=10000, overflow='drop-oldest'):
+		self.port = port
+		self.checksum = checksum # checksum mode of the frames sent to a new client, see communication.CHECKSUMS
+		self.callback = callback # /callback/ takes a datastring and returns a datastring (or None) to be sent back
+		self.maxlen = maxlen # the size and the overflow policy of the queue of received frames of each client, see FrameQueue
+		self.overflow = overflow
+		self.heartbeat = b'heartbeat'
+		self.framehead = b'framehead'
+
+		self.conns = [] # FrameProtocol of every client
+
+		self.loopthread = get_loopthread()
+		self.loopthread.run(self.__start()).result()
+		print('Server', socket.gethostbyname(socket.gethostname()), 'initiated')
+
+	async def __start(self):
+		loop = asyncio.get_running_loop()
+		self.server = await loop.create_server( lambda: FrameProtocol(self, self.checksum), '', self.port )
+		self.detecting = loop.create_task(self.__detect())
+
+	async def __detect(self, interval=1, timeout=5):
+		""" check every /interval/ seconds wether the clients are healthly connected, and send them the heartbeat signal """
+		while True:
+			for conn in list(self.conns):
+				if conn.is_silent(timeout):
+					print('\nException = Disconnected')
+					conn.close()
+				else: conn.write(self.heartbeat)
+			await asyncio.sleep(interval)
+
+##### receive and send (main functional methods) #####
+	def recv(self):
+		""" return the newest frame received and dump the others, like Server.recv """
+		datastring = None
+		for conn in list(self.conns): datastring = conn.I_frames.get_newest() or datastring
+		return datastring
+
+	def recv_all(self):
+		""" return all the received frames, client by client, in the order of arrival """
+		return [ datastring for conn in list(self.conns) for datastring in conn.I_frames.get_all() ]
+
+	def send(self, datastring):
+		""" send /datastring/ to all clients """
+		self.loopthread.call(self.__send, datastring)
+
+	def interact(self, func=None):
+		""" process every queued frame by /func/ and send the answers back, like Server.interact """
+		for conn in list(self.conns):
+			for datastring in conn.I_frames.get_all():
+				ans = func(datastring) if func else datastring
+				if ans: self.loopthread.call(conn.write, ans)
+
+	def close(self):
+		""" stop listening and close all connections """
+		self.loopthread.run(self.__close()).result()
+
+	async def __close(self):
+		self.detecting.cancel()
+		self.server.close()
+		for conn in list(self.conns): conn.close()
+		await self.server.wait_closed()
+
+	def __send(self, datastring):
+		for conn in self.conns: conn.write(datastring)
+######################################################
+
+##### called by the connections, in the event loop thread #####
+	def add(self, conn):
+		self.conns.append(conn)
+		print('\nConnected by', conn.address, ', connection number', len(self.conns))
+
+	def remove(self, conn, ex=None):
+		if conn in self.conns:
+			self.conns.remove(conn)
+			if ex: print('\nException =', ex)
+			print(conn.address, 'removed, connection number', len(self.conns))
+
+	def deliver(self, conn, datastring):
+		if not self.callback:
+			conn.I_frames.put(datastring)
+			return
+		try:	ans = self.callback(datastring)
+		except Exception as ex: print('\nException in callback =', ex)
+		else:
+			if ans: conn.write(ans)
+
+	def beat(self, conn, beats):
+		pass # heartbeats only keep the connection alive
+###############################################################
+
+	def get_connection_state(self):
+		""" wether the server is connected by at least one client """
+		return len(self.conns) > 0
+
+	def stats(self):
+		""" counters of the received frames of every client """
+		return { conn.address:conn.I_frames.stats() for conn in list(self.conns) }
+
+
+class AsyncClient():
+	""" the client of the connection, see Client """
+
+	def __init__(self, serverIP='', start=False, port=8006, checksum='sum', callback=None, maxlen=10000, overflow='drop-oldest'):
+		self.serverIP = serverIP
+		self.port = port
+		self.checksum = checksum # checksum mode of the frames sent at the beginning of a connection, see communication.CHECKSUMS
+		self.callback = callback # /callback/ takes a datastring and returns a datastring (or None) to be sent back
+		self.maxlen = maxlen # the size and the overflow policy of the queue of received frames, see FrameQueue
+		self.overflow = overflow
+		self.flag = False
+		self.heartbeat = b'heartbeat'
+		self.framehead = b'framehead'
+
+		self.conn = None
+		self.I_frames = FrameQueue(maxlen, overflow) # the queue of the current (or the last) connection
+
+		self.loopthread = get_loopthread()
+		print("Client", socket.gethostbyname(socket.gethostname()), "initiated\n")
+
+		if start: self.open() # if /start/ is true, the client starts connection as soon as it is initiated
+
+##### open, close and reconnection #####
+	def open(self):
+		""" open the connection. it keeps reconnecting in the event loop until close() is called """
+		if not self.flag:
+			self.flag = True
+			self.running = self.loopthread.run(self.__run())
+
+	def close(self):
+		if self.flag:
+			self.flag = False
+			self.loopthread.call(self.running.cancel)
+
+	def restart(self, ex=None):
+		""" drop the current connection and connect again """
+		if ex: print("\nException =", ex)
+		if self.conn: self.loopthread.call(self.conn.close)
+
+	async def __run(self, timeout=3):
+		loop = asyncio.get_running_loop()
+		try:
+			while self.flag:
+				try: transport, conn = await asyncio.wait_for( loop.create_connection( lambda: FrameProtocol(self, self.checksum), self.serverIP, self.port ), timeout=1 )
+				except Exception as ex:
+					print("Connection failed:", ex, ", waiting for reconnection...")
+					await asyncio.sleep(1)
+					continue
+
+				print("Server", self.serverIP, "connected!\n")
+				while not conn.lost.done(): # if the server is silent for /timeout/ seconds, restart the connection
+					await asyncio.wait( [conn.lost], timeout=max(timeout - (time.monotonic()-conn.last_time), 0) )
+					if not conn.lost.done() and conn.is_silent(timeout):
+						print("\nException = Disconnected")
+						conn.close()
+						await conn.lost
+		finally:
+			if self.conn: self.conn.close()
+######################################
+
+##### receive and send (main functional methods) #####
+	def recv(self):
+		""" return the newest frame received and dump the others, like Client.recv """
+		return self.I_frames.get_newest()
+
+	def recv_all(self):
+		""" return all the received frames, in the order of arrival """
+		return self.I_frames.get_all()
+
+	def send(self, datastring):
+		self.loopthread.call(self.__send, datastring)
+
+	def interact(self, func=None):
+		""" process every queued frame by /func/ and send the answers back, like Client.interact """
+		for datastring in self.I_frames.get_all():
+			ans = func(datastring) if func else None
+			if ans: self.send(ans)
+
+	def __send(self, datastring):
+		if self.conn: self.conn.write(datastring)
+######################################################
+
+##### called by the connection, in the event loop thread #####
+	def add(self, conn):
+		self.conn = conn
+		self.I_frames = conn.I_frames
+
+	def remove(self, conn, ex=None):
+		if self.conn is conn: self.conn = None
+		if ex: print("\nException =", ex)
+
+	def deliver(self, conn, datastring):
+		if not self.callback:
+			conn.I_frames.put(datastring)
+			return
+		try:	ans = self.callback(datastring)
+		except Exception as ex: print('\nException in callback =', ex)
+		else:
+			if ans: conn.write(ans)
+
+	def beat(self, conn, beats):
+		for i in range(beats): conn.write(self.heartbeat) # echo back the heartbeat signal
+##############################################################
+
+	def get_connection_state(self):
+		""" check wether the connection is healthy """
+		return self.flag and self.conn is not None
+
+	def stats(self):
+		""" counters of the received frames """
+		return self.I_frames.stats()
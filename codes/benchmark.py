@@ -0,0 +1,590 @@
+# -*- coding: utf-8 -*-
+""" micro benchmarks for the hot paths of the upper computer. run from the /codes/ directory: python benchmark.py """
+""" python benchmark.py --suite runs the regression suite instead, see SUITE """
+import io
+import sys
+import json
+import time
+import timeit
+import socket
+import select
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import numpy as np
+from struct import pack, unpack
+
+from protocol import Protocol, SensorPackage
+from communication import Framer, Server, Client, CHECKSUMS, MySelect, setup
+from aiocommunication import AsyncServer, AsyncClient
+
+
+def sensor_datastring(flag=0x0F):
+	""" generate one sensor package body (flag byte included) with random data """
+	datastring = pack('B', flag)
+	if flag & 0x01:	datastring += pack( '13f', *np.random.rand(13) )
+	if flag & 0x02:	datastring += pack( '13f', *np.random.rand(13) )
+	if flag & 0x04:	datastring += pack( '13f', *np.random.rand(13) )
+	if flag & 0x08:	datastring += pack( '10f', *np.random.rand(10) )
+	return datastring
+
+
+def decode_reference(sens, datastring):
+	""" the original unpack-based decoder of SensorPackage, kept as a reference for correctness and speed """
+	flag, = unpack( 'B', datastring[0:1] )
+	idx = 1
+	for bit, key, n in ( (0x01,'forc',12), (0x02,'disp',12), (0x04,'foot',12), (0x08,'imu',9) ):
+		if flag & bit:
+			sens.bufinflag[key], sens.bufinflag[key+'_time'] = True, True
+			sens.data[key+'_time'], = unpack( 'f', datastring[idx:idx+4] )
+			sens.data[key][:] = np.reshape( unpack('%if'%n, datastring[idx+4:idx+4+4*n]), np.shape(sens.data[key]) )
+			idx += 4 + 4*n
+
+
+def bench_decode(number=20000):
+	""" compare SensorPackage.decode with the reference decoder, for every flag layout """
+	sens1, sens2 = SensorPackage(), SensorPackage()
+	results = {}
+	for flag in (0x01, 0x08, 0x0F):
+		datastring = sensor_datastring(flag)
+
+		decode_reference(sens1, datastring)
+		sens2.decode(datastring)
+		for key in sens1.data.keys():
+			assert np.array_equal(sens1.data[key], sens2.data[key]), 'decode result of %s does not match the reference'%key
+
+		t1 = timeit.timeit(lambda: decode_reference(sens1, datastring), number=number) / number
+		t2 = timeit.timeit(lambda: sens2.decode(datastring), number=number) / number
+		results['decode_0x%02X'%flag] = (t1, t2)
+	return results
+
+
+def bench_process_many(nframes=200, number=200):
+	""" compare SensorPackage.process called frame by frame with SensorPackage.process_many on a backlog of /nframes/ frames """
+	backlog = [ sensor_datastring(0x0F if i%10 else 0x08) for i in range(nframes) ]
+	sens1, sens2 = SensorPackage(), SensorPackage()
+
+	def process_each():
+		for key in sens1.buflen.keys(): sens1.buflen[key] = 0 # reset the buffers so that no log file is written
+		for datastring in backlog: sens1.process(datastring)
+	def process_many():
+		for key in sens2.buflen.keys(): sens2.buflen[key] = 0
+		sens2.process_many(backlog)
+
+	process_each()
+	process_many()
+	for key in sens1.data.keys():
+		assert sens1.buflen[key] == sens2.buflen[key], 'buffer length of %s does not match'%key
+		assert np.array_equal(sens1.bufferGet()[key], sens2.bufferGet()[key]), 'buffer of %s does not match'%key
+
+	t1 = timeit.timeit(process_each, number=number) / number
+	t2 = timeit.timeit(process_many, number=number) / number
+	return { 'process_%i_frames'%nframes: (t1, t2) }
+
+
+def bench_display_buffer(buflens=(25, 500, 10000), number=2000):
+	""" compare bufferShift+bufferIn+filter of the shifting display buffer with the ring buffer, for several buffer lengths """
+	results = {}
+	frames = [ sensor_datastring(0x0F) for i in range(50) ]
+	for buflen in buflens:
+		sens1, sens2 = SensorPackage(buflen_max=buflen), SensorPackage(buflen_max=buflen, ring=True)
+
+		def step(sens, datastring):
+			sens.decode(datastring)
+			if sens.checkBufferFull(): sens.bufferShift()
+			sens.bufferIn()
+			return sens.filter()
+
+		for i in range(buflen+len(frames)): # fill the buffers and go on past the end
+			step(sens1, frames[i%len(frames)])
+			step(sens2, frames[i%len(frames)])
+		for key in sens1.data.keys():
+			assert np.array_equal(sens1.bufferGet()[key], sens2.bufferGet()[key]), 'ring buffer of %s does not match'%key
+			assert np.array_equal(sens1.filter()[key], sens2.filter()[key]), 'ring buffer filter of %s does not match'%key
+
+		t1 = timeit.timeit(lambda: step(sens1, frames[0]), number=number) / number
+		t2 = timeit.timeit(lambda: step(sens2, frames[0]), number=number) / number
+		results['display_%i'%buflen] = (t1, t2)
+	return results
+
+
+def bench_filter(size=50, number=2000):
+	""" compare averaging the buffer on every filter() call with the incremental moving average updated in bufferIn """
+	frames = [ sensor_datastring(0x0F) for i in range(size) ]
+	sens1, sens2 = SensorPackage(), SensorPackage()
+	sens2.setFilter('mean', size=size)
+
+	def step(sens, datastring):
+		sens.decode(datastring)
+		if sens.checkBufferFull(): sens.bufferShift()
+		sens.bufferIn()
+		return sens.filter(filter_size=size)
+
+	for datastring in frames:
+		step(sens1, datastring)
+		step(sens2, datastring)
+	for key in sens1.data.keys():
+		assert np.allclose(sens1.filter(filter_size=size)[key], sens2.filter()[key]), 'filtered %s does not match'%key
+
+	t1 = timeit.timeit(lambda: step(sens1, frames[0]), number=number) / number
+	t2 = timeit.timeit(lambda: step(sens2, frames[0]), number=number) / number
+	return { 'filter_%i'%size: (t1, t2) }
+
+
+def frame_stream(nbytes, framelen=200):
+	""" generate a raw byte stream of about /nbytes/ with frames of /framelen/ bytes, heartbeats, and some corrupted frames and garbage in between """
+	clt = Client()
+	frames, chunks = [], []
+	while sum(len(chunk) for chunk in chunks) < nbytes:
+		datastring = bytes(np.random.randint(0, 256, framelen, dtype=np.uint8))
+		chunk = clt.encode(datastring)
+		r = np.random.rand()
+		if r < 0.05:	chunks.append(clt.heartbeat)
+		elif r < 0.07:	chunks.append(b'garbage')
+		if 0.07 <= r < 0.09:	chunk = chunk[:-1] + bytes([ (chunk[-1]+1) % 256 ]) # wrong checksum, this frame is dropped
+		else:					frames.append(datastring)
+		chunks.append(chunk)
+	return b''.join(chunks), frames
+
+
+def decode_stream_reference(stream, framehead=b'framehead', heartbeat=b'heartbeat'):
+	""" the original framing algorithm of Server.decode / Client.decode, kept as a reference for correctness and speed """
+	frames, beats = [], 0
+	while True:
+		len_st = len(stream)
+		idx_hd = len_st if (framehead not in stream) else stream.index(framehead)
+		idx_ht = len_st if (heartbeat not in stream) else stream.index(heartbeat)
+		idx = min(idx_hd, idx_ht)
+
+		if idx == len_st: break
+		elif idx == idx_ht:
+			beats += 1
+			idx += len(heartbeat)
+		elif idx == idx_hd:
+			i = idx + len(framehead) + 4
+			if len_st < i: break
+			len_dt, = unpack( 'I', stream[i-4 : i] )
+			if len_st < len_dt + i + 8: break
+			datastring = stream[i : i+len_dt]
+			i += len_dt
+			checksum, = unpack( 'Q', stream[i : i+8] )
+			if checksum != sum(datastring):	idx += len(framehead)
+			else:
+				frames.append(datastring)
+				idx = i + 8
+		stream = stream[idx:]
+	return frames, beats, stream
+
+
+def bench_framing(sizes=(2**20, 4*2**20), chunksize=256*1024):
+	""" compare the original framing with Framer on backlogs of several MB, received in chunks of /chunksize/ bytes """
+	results = {}
+	for nbytes in sizes:
+		stream, frames = frame_stream(nbytes)
+		chunks = [ stream[i:i+chunksize] for i in range(0, len(stream), chunksize) ]
+
+		def decode_reference():
+			rest, frames, beats = b'', [], 0
+			for chunk in chunks:
+				f, b, rest = decode_stream_reference(rest + chunk)
+				frames += f
+				beats += b
+			return frames, beats
+		def decode_framer():
+			framer, frames, beats = Framer(), [], 0
+			for chunk in chunks:
+				framer.feed(chunk)
+				f, b = framer.decode()
+				frames += f
+				beats += b
+			return frames, beats
+
+		assert decode_reference() == decode_framer() == (frames, stream.count(b'heartbeat')), 'framing result does not match'
+
+		t1 = timeit.timeit(decode_reference, number=1)
+		t2 = timeit.timeit(decode_framer, number=1)
+		results['framing_%iMB'%(nbytes/2**20)] = (t1, t2)
+	return results
+
+
+def bench_checksum(sizes=(64, 1024, 16384, 262144), number=200):
+	""" per-frame cost of every checksum mode, compared with the original byte sum, for several payload sizes """
+	results = {}
+	for size in sizes:
+		datastring = bytes(np.random.randint(0, 256, size, dtype=np.uint8))
+		t1 = timeit.timeit(lambda: sum(datastring), number=number) / number
+		for mode, (version, checksum) in CHECKSUMS.items():
+			t2 = timeit.timeit(lambda: checksum(datastring), number=number) / number
+			results['%s_%iB'%(mode, size)] = (t1, t2)
+
+	datastring = bytes(np.random.randint(0, 256, 1024, dtype=np.uint8))
+	for mode in CHECKSUMS.keys(): # the whole frame through Framer.encode and Framer.decode, compared with 'sum'
+		framer = Framer(mode=mode)
+		def roundtrip():
+			framer.feed(framer.encode(datastring))
+			return framer.decode()
+		assert roundtrip() == ([datastring], 0) and framer.mode == mode, 'checksum mode %s does not work'%mode
+		t2 = timeit.timeit(roundtrip, number=number*10) / number / 10
+		if mode == 'sum': t1 = t2
+		results['frame_%s_1024B'%mode] = (t1, t2)
+	return results
+
+
+def bench_transport_latency(duration=2.0, interval=0.01, tick=0.04):
+	""" receive latency on loopback: Server/Client polled every /tick/ seconds (as MainWindow.hear does), against AsyncServer/AsyncClient delivering by callback """
+	""" the server sends a frame stamped with time.perf_counter() every /interval/ seconds for /duration/ seconds """
+	def sending(srv):
+		time_end = time.perf_counter() + duration
+		while time.perf_counter() < time_end:
+			srv.send( pack('d', time.perf_counter()) )
+			time.sleep(interval)
+	def latency(datastring, lats):
+		lats.append( time.perf_counter() - unpack('d', datastring)[0] )
+
+	lats1, lats2 = [], []
+
+	srv, clt = Server(), Client('127.0.0.1', start=True)
+	while not (clt.get_connection_state() and srv.get_connection_state()): srv.interact(lambda d: None); time.sleep(0.01)
+	thrd = threading.Thread(target=sending, args=(srv,))
+	thrd.start()
+	while thrd.is_alive():
+		clt.interact(lambda datastring: latency(datastring, lats1))
+		time.sleep(tick)
+	clt.close()
+	srv.close()
+
+	srv = AsyncServer(port=8007)
+	clt = AsyncClient('127.0.0.1', start=True, port=8007, callback=lambda datastring: latency(datastring, lats2))
+	while not (clt.get_connection_state() and srv.get_connection_state()): time.sleep(0.01)
+	sending(srv)
+	clt.close()
+	srv.close()
+
+	assert len(lats2) >= len(lats1) * 0.9, 'frames are lost by the asynchronous transport'
+	return { 'latency_mean': (np.mean(lats1), np.mean(lats2)), 'latency_max': (np.max(lats1), np.max(lats2)) }
+
+
+def bench_socket_receive(nbytes=32*2**20):
+	""" receive /nbytes/ of frames through a local socket pair: the original sk.recv(1024) and bytes concatenation, against Framer.recv with recv_into """
+	""" returns (reference, current) of the number of recv calls per MB, and of the time per MB """
+	stream, frames = frame_stream(nbytes, framelen=1000)
+
+	def receive(read):
+		sk1, sk2 = socket.socketpair()
+		thrd = threading.Thread(target=sk1.sendall, args=(stream,))
+		time0 = time.perf_counter()
+		thrd.start()
+		reads, total = read(sk2)
+		thrd.join()
+		sk1.close()
+		sk2.close()
+		return reads, time.perf_counter() - time0
+
+	def read_reference(sk):
+		framer, reads, received, got = Framer(), 0, b'', 0
+		while received is not None and framer.nbytes < len(stream):
+			for sk in MySelect([sk], 'r'):
+				datastring = sk.recv(1024)
+				reads += 1
+				framer.feed(datastring)
+				got += len(framer.decode()[0])
+		assert got == len(frames), 'frames are lost'
+		return reads, framer.nbytes
+	def read_framer(sk):
+		framer, got = Framer(), 0
+		while framer.nbytes < len(stream):
+			if MySelect([sk], 'r') and framer.recv(sk): got += len(framer.decode()[0])
+		assert got == len(frames), 'frames are lost'
+		return framer.reads, framer.nbytes
+
+	reads1, t1 = receive(read_reference)
+	reads2, t2 = receive(read_framer)
+	mb = len(stream) / 2**20
+	return { 'recv_calls_per_MB': (reads1/mb, reads2/mb), 'recv_time_per_MB': (t1/mb, t2/mb) }
+
+
+def bench_socket_send(nframes=100000, batch=100, framelen=64):
+	""" send /nframes/ small frames through a local socket pair, /batch/ frames pending at each write: """
+	""" the original sendall(encode()) per frame, against Framer.put and one gathering Framer.send per write """
+	""" returns (reference, current) of the number of send calls per frame, and of the time per frame """
+	datastrings = [ bytes([i%256]) * framelen for i in range(batch) ]
+
+	def transfer(write, blocking):
+		sk1, sk2 = socket.socketpair()
+		sk1.setblocking(blocking)
+		framer = Framer()
+		nbytes = nframes // batch * len(b''.join( framer.encode(datastring) for datastring in datastrings ))
+		thrd = threading.Thread(target=drain, args=(sk2, nbytes))
+		thrd.start()
+		time0 = time.perf_counter()
+		writes = sum( write(sk1, framer) for i in range(nframes // batch) )
+		thrd.join()
+		sk1.close()
+		sk2.close()
+		return writes, time.perf_counter() - time0
+
+	def drain(sk, nbytes):
+		while nbytes > 0: nbytes -= len(sk.recv(262144))
+
+	def write_reference(sk, framer):
+		for datastring in datastrings: sk.sendall(framer.encode(datastring))
+		return len(datastrings)
+	def write_framer(sk, framer):
+		writes = framer.writes
+		for datastring in datastrings: framer.put(datastring)
+		while framer.out:
+			framer.send(sk)
+			if framer.out: select.select([], [sk], [], 1) # wait until the socket takes more
+		return framer.writes - writes
+
+	writes1, t1 = transfer(write_reference, True)
+	writes2, t2 = transfer(write_framer, False)
+	return { 'send_calls_per_frame': (writes1/nframes, writes2/nframes), 'send_time_per_frame': (t1/nframes, t2/nframes) }
+
+
+def bench_broadcast(clients=(1, 4, 16), framelen=1024, number=500):
+	""" queue one frame for every client: framed client by client as the original Server.write did, against encoded once and shared like Server.send """
+	""" returns (reference, current) of the time per broadcast frame """
+	datastring = bytes(range(256)) * (framelen // 256)
+	results = {}
+	for n in clients:
+		framers = [ Framer() for i in range(n) ]
+
+		def broadcast_reference():
+			for framer in framers:
+				framer.put(datastring)
+				framer.out.clear()
+		def broadcast_shared():
+			frames = {}
+			for framer in framers:
+				if framer.mode not in frames: frames[framer.mode] = framer.encode_parts(datastring)
+				framer.queue(*frames[framer.mode])
+				framer.out.clear()
+
+		t1 = min(timeit.repeat(broadcast_reference, number=number, repeat=5)) / number
+		t2 = min(timeit.repeat(broadcast_shared, number=number, repeat=5)) / number
+		results['broadcast_%i_clients' % n] = (t1, t2)
+	return results
+
+
+def bench_many_clients(clients=(1, 50, 100, 200), duration=2.0, number=200, port=8008):
+	""" a Server connected by /clients/ local clients: the CPU use of the whole process while they are idle (only heartbeats) for /duration/ seconds, """
+	""" the wakeups of the server loop per second, and the round trip of a small frame echoed by the server callback, measured /number/ times """
+	""" the loop sleeps on the selector until something happens, so all of them should stay flat as clients are added """
+	srv = Server(port=port, callback=lambda datastring: datastring)
+	sks = []
+	results = {}
+	for n in clients:
+		while len(sks) < n: sks.append( setup(socket.create_connection(('127.0.0.1', port))) )
+		while len(srv.I_sockets) < n: time.sleep(0.01)
+		for sk in sks: sk.send(b'heartbeat') # keep the idle clients from being timed out
+
+		wakeups, cpu0, time0 = srv.wakeups, time.process_time(), time.perf_counter()
+		time.sleep(duration)
+		cpu, wakeups = (time.process_time()-cpu0) / (time.perf_counter()-time0), (srv.wakeups-wakeups) / (time.perf_counter()-time0)
+
+		probe, framer, lats = sks[0], Framer(), []
+		for i in range(number):
+			time0 = time.perf_counter()
+			framer.put(b'probe' * 10)
+			framer.send(probe)
+			while not framer.decode()[0]:
+				select.select([probe], [], [], 1)
+				framer.recv(probe)
+			lats.append(time.perf_counter() - time0)
+		results[n] = { 'cpu':cpu, 'wakeups':wakeups, 'rtt_median':np.median(lats), 'rtt_p99':np.percentile(lats, 99) }
+
+	for sk in sks: sk.close()
+	srv.close()
+	return results
+
+
+##### regression suite #####
+""" the hot paths measured alone, without reference: every result is the time of one operation in seconds, the best of /repeat/ runs """
+""" they are stored as a JSON baseline, and a later run fails if any is slower than the baseline by more than a threshold: """
+"""		python benchmark.py --suite --save ../benchmark_baseline.json """
+"""		python benchmark.py --suite --compare ../benchmark_baseline.json --threshold 0.2 """
+""" a baseline only holds for the machine it was measured on, its python and numpy versions are stored with it """
+
+def best(func, number, repeat=5):
+	""" the shortest time of one call of /func/, over /repeat/ runs of /number/ calls """
+	return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def suite_sensor(filepath, repeat=5):
+	""" SensorPackage: decode, encode, bufferIn, bufferOut, bufferShift and filter, on frames of every channel (flag 0x0F) """
+	datastring = sensor_datastring(0x0F)
+	results = {}
+
+	sens = SensorPackage(filepath=filepath)
+	updated = dict.fromkeys(sens.bufinflag.keys(), True)
+	empty, full = dict.fromkeys(sens.buflen.keys(), 0), dict.fromkeys(sens.buflen.keys(), sens.buflen_max)
+	def encode():
+		sens.bufinflag.update(updated)
+		return sens.encode()
+	def buffer_in():
+		sens.bufinflag.update(updated)
+		if sens.checkBufferFull(): sens.buflen.update(empty) # dumped, so that no log file is written
+		sens.bufferIn()
+	def buffer_out():
+		sens.buflen.update(full)
+		sens.bufferOut() # the full buffers are handed to the log writer, which blocks when it falls behind
+	results['sens_decode'] = best(lambda: sens.decode(datastring), 20000, repeat)
+	results['sens_encode'] = best(encode, 20000, repeat)
+	results['sens_bufferIn'] = best(buffer_in, 20000, repeat)
+	results['sens_bufferOut'] = best(buffer_out, 20, repeat)
+	sens.close()
+
+	sens = SensorPackage(filepath=filepath)
+	sens.buflen.update(full)
+	def buffer_shift():
+		sens.bufferShift()
+		sens.buflen.update(full)
+	results['sens_bufferShift'] = best(buffer_shift, 2000, repeat)
+	results['sens_filter'] = best(sens.filter, 2000, repeat)
+	sens.setFilter('mean', size=5)
+	results['sens_bufferIn_filtered'] = best(buffer_in, 20000, repeat)
+	return results
+
+
+def suite_framing(nbytes=2**20, chunksize=65536, framelen=200, repeat=5):
+	""" Framer, which does the framing of Server.decode and Client.decode: a stream of /nbytes/ received in chunks (per MB), and the encoding of one frame """
+	stream, frames = frame_stream(nbytes, framelen)
+	chunks = [ stream[i:i+chunksize] for i in range(0, len(stream), chunksize) ]
+	def decode():
+		framer, got = Framer(), 0
+		for chunk in chunks:
+			framer.feed(chunk)
+			got += len(framer.decode()[0])
+		return got
+	assert decode() == len(frames), 'frames are lost'
+	framer, datastring = Framer(), frames[0]
+	return { 'framer_decode_MB': best(decode, 1, repeat) * 2**20 / len(stream), 'framer_encode': best(lambda: framer.encode(datastring), 20000, repeat) }
+
+
+def suite_protocol(filepath, batch=200, repeat=5):
+	""" Protocol.distrib of one sensor frame, and Protocol.distrib_many of /batch/ frames (per frame), decoding and logging included """
+	prot = Protocol()
+	prot.sens = SensorPackage(filepath=filepath)
+	frame = pack('3B', prot.ver, 0x00, 0x01) + sensor_datastring(0x0F)
+	backlog = [frame] * batch
+	results = { 'protocol_distrib': best(lambda: prot.distrib(frame), 20000, repeat),
+				'protocol_distrib_many': best(lambda: prot.distrib_many(backlog), 100, repeat) / batch }
+	prot.sens.close()
+	return results
+
+
+def suite_loopback(filepath, nframes=20000, port=8009, repeat=3, timeout=5):
+	""" end to end on loopback, per frame: /nframes/ sensor frames sent by a Server, received by a Client, and decoded and logged by Protocol.distrib_many """
+	""" the frames lost are counted instead of failing the suite: a run ends when no frame has arrived for /timeout/ seconds """
+	srv, clt = Server(port=port, maxout=2**30), Client('127.0.0.1', start=True, maxlen=nframes, port=port)
+	prot = Protocol()
+	prot.sens = SensorPackage(filepath=filepath)
+	while not (clt.get_connection_state() and srv.get_connection_state()): time.sleep(0.01)
+	frame = pack('3B', prot.ver, 0x00, 0x01) + sensor_datastring(0x0F)
+
+	times, lost = [], 0
+	for i in range(repeat):
+		cnt, time0 = prot.cnt, time.perf_counter()
+		for j in range(nframes): srv.send(frame)
+		time1 = time0 # the time of the last frames received
+		while prot.cnt - cnt < nframes and time.perf_counter() - time1 < timeout:
+			clt.wait(0.1)
+			frames = clt.recv_all()
+			if frames: time1 = time.perf_counter()
+			prot.distrib_many(frames)
+		times.append( (time1 - time0) / max(prot.cnt - cnt, 1) )
+		lost += nframes - (prot.cnt - cnt)
+	prot.sens.close()
+	clt.close()
+	srv.close()
+	return { 'loopback_frame': min(times), 'loopback_lost': lost }
+
+
+COUNTS = ('_lost',) # the results with these suffixes are counts, not times
+
+SUITE = { 'sensor':suite_sensor, 'framing':lambda filepath: suite_framing(), 'protocol':suite_protocol, 'loopback':suite_loopback }
+
+def run_suite(groups=None):
+	""" run the groups of SUITE (all of them by default). the log files written meanwhile go to a temporary directory, and the prints are kept quiet """
+	results = {}
+	filepath = tempfile.mkdtemp()
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			for name in groups if groups else SUITE.keys(): results.update( SUITE[name](filepath) )
+	finally: shutil.rmtree(filepath, ignore_errors=True)
+	return results
+
+
+def save_baseline(results, filename):
+	meta = { 'python':platform.python_version(), 'numpy':np.__version__, 'machine':platform.platform(), 'date':time.strftime('%Y-%m-%d %H:%M:%S') }
+	with open(filename, 'w') as f: json.dump({ 'meta':meta, 'results':results }, f, indent=1, sort_keys=True)
+
+def load_baseline(filename):
+	with open(filename) as f: return json.load(f)
+
+
+def compare(results, baseline, threshold=0.2):
+	""" the results slower than /baseline/ by more than /threshold/ (0.2 means 20 %), { name:(baseline, current) }. names missing on either side are ignored """
+	""" the counts (see COUNTS) are compared the same way, so that any frame lost against a baseline without loss is a regression """
+	return { name:(baseline[name], t) for name, t in results.items() if name in baseline and t > baseline[name] * (1+threshold) }
+############################
+
+
+def report(results, unit='us', scale=1e6):
+	""" print (reference, current) pairs. times are shown in microseconds by default, give unit='' and scale=1 for counts """
+	for name, (t1, t2) in results.items():
+		print('%-20s reference %8.2f %-2s    current %8.2f %-2s    speedup %5.2fx' % (name, t1*scale, unit, t2*scale, unit, t1/t2))
+
+
+def comparisons():
+	""" the current hot paths against the original implementations """
+	report(bench_decode())
+	report(bench_process_many())
+	report(bench_display_buffer())
+	report(bench_filter())
+	report(bench_framing())
+	report(bench_checksum())
+	report(bench_transport_latency())
+	results = bench_socket_receive()
+	report({ 'recv_calls_per_MB':results.pop('recv_calls_per_MB') }, unit='', scale=1)
+	report(results, unit='ms', scale=1e3)
+	results = bench_socket_send()
+	report({ 'send_calls_per_frame':results.pop('send_calls_per_frame') }, unit='', scale=1)
+	report(results)
+	report(bench_broadcast())
+	for n, result in bench_many_clients().items():
+		print('%-4i clients         cpu %5.1f %%    wakeups %5.1f /s    round trip median %7.1f us    p99 %7.1f us' % (n, result['cpu']*100, result['wakeups'], result['rtt_median']*1e6, result['rtt_p99']*1e6))
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='benchmarks of the upper computer. without --suite, the current hot paths are compared with the original implementations')
+	parser.add_argument('--suite', action='store_true', help='run the regression suite, see SUITE')
+	parser.add_argument('--only', nargs='+', choices=list(SUITE.keys()), default=None, help='run these groups of the suite only')
+	parser.add_argument('--save', default=None, metavar='FILE', help='store the results of the suite as a JSON baseline')
+	parser.add_argument('--compare', default=None, metavar='FILE', help='compare the results of the suite with a JSON baseline, exit with status 1 on regression')
+	parser.add_argument('--threshold', type=float, default=0.2, help='the slowdown counted as a regression (default 0.2, i.e. 20 %%)')
+	args = parser.parse_args(argv)
+	if not args.suite:
+		comparisons()
+		return 0
+
+	results = run_suite(args.only)
+	baseline = load_baseline(args.compare)['results'] if args.compare else {}
+	show = lambda name, value: '%10i   '%value if name.endswith(COUNTS) else '%10.3f us'%(value*1e6)
+	for name, t in results.items():
+		if name in baseline and baseline[name]:	print('%-24s %s    baseline %s    %+6.1f %%' % (name, show(name, t), show(name, baseline[name]), (t/baseline[name]-1)*100))
+		elif name in baseline:					print('%-24s %s    baseline %s' % (name, show(name, t), show(name, baseline[name])))
+		else:									print('%-24s %s' % (name, show(name, t)))
+	if args.save: save_baseline(results, args.save)
+
+	regressions = compare(results, baseline, args.threshold)
+	for name, (t0, t) in regressions.items(): print('REGRESSION %s: %s -> %s' % (name, show(name, t0).strip(), show(name, t).strip()))
+	return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
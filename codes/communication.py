@@ -1,8 +1,14 @@
 import socket
 import select
+import selectors
 import time
 import threading
-from struct import pack, unpack
+import zlib
+import collections
+import itertools
+from struct import pack, unpack_from
+
+from profiling import profiled
 
 
 def MySelect(sk_list, operation):
@@ -15,184 +21,643 @@ def MySelect(sk_list, operation):
 	return []
 
 
+def setup(sk):
+	""" prepare a connected socket: non-blocking, so that a slow peer never stalls a write (see Framer.send), """
+	""" and without Nagle's algorithm, so that small command frames leave at once. the frames are coalesced by Framer.send instead """
+	sk.setblocking(False)
+	sk.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+	return sk
+
+
+class Scheduler():
+	""" run periodic jobs (see looptimer) in one separate thread """
+	""" the thread sleeps until the nearest deadline instead of spinning. deadlines are kept on a monotonic clock and advance by whole intervals, so the period does not drift """
+
+	def __init__(self):
+		self.jobs = []
+		self.lock = threading.Lock()
+		self.event = threading.Event() # wakes up the thread when the jobs change
+
+	def add(self, job):
+		with self.lock:
+			if job not in self.jobs:
+				job.deadline = time.monotonic() # a job runs as soon as it is added
+				self.jobs.append(job)
+		self.event.set()
+		if not self.is_alive():
+			self.thrd = threading.Thread(target=self.__loop, name='Scheduler', daemon=True) # daemon means the thread terminates as the main thread exits
+			self.thrd.start()
+
+	def remove(self, job):
+		with self.lock:
+			if job in self.jobs: self.jobs.remove(job)
+		self.event.set()
+
+	def is_alive(self):
+		try:	return self.thrd.is_alive()
+		except:	return False
+
+	def stats(self):
+		""" jitter statistics of every job, see looptimer.stats() """
+		with self.lock: return [ job.stats() for job in self.jobs ]
+
+	def __loop(self):
+		while True:
+			with self.lock: deadline = min( [job.deadline for job in self.jobs], default=None )
+			if deadline is None:	self.event.wait()
+			else:					self.event.wait( max(deadline - time.monotonic(), 0) )
+			self.event.clear()
+
+			now = time.monotonic()
+			with self.lock: jobs = [ job for job in self.jobs if job.deadline <= now ]
+			for job in jobs: job.run(now) # jobs are run without the lock, so that they can start or stop timers themselves
+
+
+scheduler = Scheduler() # all looptimers share this scheduler by default
+
+
 class looptimer():
 	""" a timer that runs every /interval/ seconds """
-	""" runs in a separate thread without interfering with the main thread """
+	""" runs in a separate thread without interfering with the main thread. all timers share one thread, see Scheduler """
 
-	def __init__(self, interval, func, start=False):
+	def __init__(self, interval, func, start=False, scheduler=scheduler):
 		self.interval = interval
 		self.func = func # /func/ is the function that needs to be executed iteratively
+		self.scheduler = scheduler
 		self.flag = False
+		self.deadline = 0.0
+
+		# jitter statistics: lateness is the delay of a run after its deadline
+		self.cnt = 0
+		self.missed = 0 # how many runs are skipped because the previous run took too long
+		self.errors = 0 # how many runs have raised an exception
+		self.late_max = 0.0
+		self.late_sum = 0.0
+		self.late_sqr = 0.0
+
 		if start: self.start() # if /start/ is provided as True, the timer starts as soon as initiation
 
 	def start(self):
 		self.flag = True
-		self.__start_loop()
+		self.scheduler.add(self)
 
 	def stop(self):
 		self.flag = False # when /stop/ is called, the timer will finish the current iteration and then stop
+		self.scheduler.remove(self)
 
 	def is_alive(self):
-		try:	return self.thrd.is_alive()
-		except:	return False
+		return self.flag
+
+	def run(self, now):
+		""" called by the scheduler when the deadline is reached """
+		if not self.flag: return # stopped after the scheduler picked it up
+		late = now - self.deadline
+		self.cnt += 1
+		self.late_max = max(self.late_max, late)
+		self.late_sum += late
+		self.late_sqr += late * late
+
+		try:	self.func()
+		except Exception as ex: # the thread is shared by every timer, so an exception must not end it
+			self.errors += 1
+			print('\nException in', getattr(self.func, '__qualname__', self.func), '=', repr(ex))
+
+		self.deadline += self.interval
+		now = time.monotonic()
+		if self.deadline < now: # behind the schedule, skip the missed runs instead of running them in a burst
+			skip = int( (now - self.deadline) / self.interval ) + 1
+			self.missed += skip
+			self.deadline += skip * self.interval
+
+	def stats(self):
+		return {
+			'func':			getattr(self.func, '__qualname__', str(self.func)),
+			'interval':		self.interval,
+			'runs':			self.cnt,
+			'missed':		self.missed,
+			'errors':		self.errors,
+			'late_mean':	self.late_sum / self.cnt if self.cnt else 0.0,
+			'late_rms':		(self.late_sqr / self.cnt)**0.5 if self.cnt else 0.0,
+			'late_max':		self.late_max	}
+
+
+# checksum modes of the frame trailer: (version byte, checksum function). the version byte replaces the last byte of the frame head
+# 'sum' is the original byte sum, its version byte 0x64 is b'd', so 'sum' frames keep the original head b'framehead' and old firmware understands them
+CHECKSUMS = {
+	'sum':		(0x64, sum),
+	'crc32':	(0x02, zlib.crc32),
+	'adler32':	(0x03, zlib.adler32)	}
+
+# the most buffers given to one sendmsg() call, below the IOV_MAX of common systems (1024 on Linux)
+SENDMSG_MAX = 512
+
+
+class Framer():
+	""" extract frames from a raw byte stream, and frame the data to be sent. see encode() for the structure of the frame """
+	""" the stream is kept in a preallocated bytearray: bytes before /pos/ are processed, bytes from /pos/ to /end/ are waiting, and the rest is free space """
+	""" processed bytes are only removed from the buffer once in a while. the buffer grows when needed and is never shrunk """
+	""" frames of every checksum mode are accepted. /mode/ is the mode used by encode(): it starts as given, and then follows the last valid frame received, """
+	""" so that a peer that only knows 'sum' is always answered with 'sum' """
+
+	def __init__(self, framehead=b'framehead', heartbeat=b'heartbeat', mode='sum', compact_size=65536, readsize=(4096, 262144)):
+		self.framehead = framehead
+		self.prefix = framehead[:-1] # the frame head without the version byte
+		self.heartbeat = heartbeat
+		self.mode = mode
+		self.modes = { version:mode for mode, (version, func) in CHECKSUMS.items() }
+		self.compact_size = compact_size # processed bytes are removed when they exceed this size and half of the buffer
+
+		self.buf = bytearray(readsize[0])
+		self.pos = 0
+		self.end = 0
+		self.found   = { self.prefix:-1, heartbeat:-1 }	# index of the next marker found in the buffer (-1 if not found)
+		self.scanned = { self.prefix:0,  heartbeat:0  }	# the marker does not start anywhere before this index, so the next search begins here
+
+		self.readsize_min, self.readsize_max = readsize # the size of one socket read adapts between these limits, see recv()
+		self.readsize = self.readsize_min
+		self.reads = 0		# how many times the socket has been read
+		self.nbytes = 0		# how many bytes have been received
+		self.frames = 0		# how many valid frames have been received
+		self.beats = 0		# how many heartbeats have been received
+		self.failures = 0	# how many frames have failed the checksum
+		self.resyncs = 0	# how many times bytes have been skipped to find the next frame head or heartbeat (garbage, a failed frame, an unknown version)
+
+		self.out = collections.deque()	# buffers waiting to be sent, see put() and send()
+		self.pending = 0	# how many bytes are waiting in /out/
+		self.writes = 0		# how many times the socket has been written
+		self.nsent = 0		# how many bytes have been sent
+		self.skipped = 0	# how many broadcast frames have been skipped because too many bytes were waiting, see Server.send()
+
+	def feed(self, datastring):
+		""" add received raw bytes to the stream """
+		self.reserve(len(datastring))
+		self.buf[self.end : self.end+len(datastring)] = datastring
+		self.end += len(datastring)
+		self.nbytes += len(datastring)
+
+	def recv(self, sk):
+		""" read all the data available from socket /sk/ straight into the buffer. return the number of bytes read (0 if the connection is closed, None if a non-blocking socket has nothing to read) """
+		""" the read size doubles after a read that fills it, and halves after a read that uses less than a quarter of it """
+		total = 0
+		while True:
+			self.reserve(self.readsize)
+			try:
+				with memoryview(self.buf) as view: n = sk.recv_into( view[self.end : self.end+self.readsize] )
+			except BlockingIOError: # a non-blocking socket has nothing more to read
+				if not total: return None
+				break
+			self.end += n
+			self.reads += 1
+			total += n
+			if n < self.readsize: # the socket is drained
+				if n < self.readsize // 4: self.readsize = max(self.readsize // 2, self.readsize_min)
+				break
+			self.readsize = min(self.readsize * 2, self.readsize_max)
+			if not MySelect([sk], 'r'): break
+		self.nbytes += total
+		return total
+
+	def reserve(self, size):
+		""" make sure that there are /size/ bytes of free space after /end/ """
+		if len(self.buf) - self.end >= size: return
+		if self.pos: self.compact()
+		if len(self.buf) - self.end < size: self.buf.extend( bytes( max(size, len(self.buf)) ) ) # at least double the buffer, so that growing is rare
 
-	def __start_loop(self):
-		""" put the loop in a separate and start it """
-		if not self.is_alive():
-			self.thrd = threading.Thread(target=self.__loop, daemon=True) # daemon means the thread terminates as the main thread exits
-			self.thrd.start()
+	def decode(self):
+		""" extract all complete frames from the stream. return the list of frames and the number of heartbeats met """
+		frames, beats = [], 0
+		buf = self.buf
 
-	def __loop(self):
-		""" main loop of the timer, iteratively execute the function provided """
-		while self.flag:
-			time1 = time.time()
-			self.func()
-			while time.time()-time1 < self.interval and self.flag: pass
+		while True:
+			idx_hd = self.find(self.prefix)
+			idx_ht = self.find(self.heartbeat)
+
+			if idx_hd == -1 and idx_ht == -1:					# neither head nor heart in the stream. skip the bytes that cannot be the start of a marker, and wait for the next receive
+				self.pos = max( self.pos, self.end - max(len(self.prefix), len(self.heartbeat)) + 1 )
+				break
+			elif idx_hd == -1 or -1 < idx_ht < idx_hd:			# heart in the stream, count and skip it
+				if idx_ht > self.pos: self.resyncs += 1
+				beats += 1
+				self.pos = idx_ht + len(self.heartbeat)
+			else:												# head in the stream, read the package
+				if idx_hd > self.pos: self.resyncs += 1
+				self.pos = idx_hd
+				i = idx_hd + len(self.framehead) + 4
+				if self.end < i: break
+				mode = self.modes.get( buf[i-5] )				# the version byte, which tells the checksum mode
+				if not mode:
+					self.pos += len(self.prefix)				# unknown version, skip the head and continue
+					continue
+				len_dt, = unpack_from( 'I', buf, i-4 )			# the length of the package, maximum 2^32-1 bytes
+				if self.end < len_dt + i + 8: break				# the whole package cannot fit in the stream, wait for the next receive
+				checksum, = unpack_from( 'Q', buf, i+len_dt )	# 'Q' stands for long unsigned integer, takes 8 bytes
+				with memoryview(buf) as view:
+					if checksum != CHECKSUMS[mode][1]( view[i : i+len_dt] ):	# check failed, skip the head and continue
+						self.pos += len(self.framehead)
+						self.failures += 1
+					else:
+						frames.append( bytes(view[i : i+len_dt]) )	# check succeeded. the frame is copied out once, because the buffer keeps changing
+						self.pos = i + len_dt + 8				# continue from the last frame tail
+						self.mode = mode						# answer the peer in the mode it uses
+
+		if self.pos > self.compact_size and self.pos * 2 > self.end: self.compact()
+		self.frames += len(frames)
+		self.beats += beats
+		return frames, beats
+
+	def encode(self, datastring):
+		""" add head and tail to the frame so that it can be safely transferred """
+		""" frame structure: head (frame head with the version byte as its last byte) | length of data ('I') | data | checksum of data ('Q') """
+		return b''.join(self.encode_parts(datastring))
+
+	def encode_parts(self, datastring):
+		""" the frame of encode() as three buffers: head with length, data (not copied) and tail """
+		version, checksum = CHECKSUMS[self.mode]
+		return self.prefix + pack('=BI', version, len(datastring)), datastring, pack('Q', checksum(datastring))
+
+	def put(self, datastring):
+		""" frame /datastring/ and queue it to be sent by send(). the heartbeat signal is queued as it is """
+		if datastring == self.heartbeat: self.queue(datastring)
+		else: self.queue(*self.encode_parts(datastring))
+
+	def queue(self, *parts):
+		""" queue buffers to be sent as they are. they are only referenced, so the same immutable frame may be queued by many framers """
+		self.out.extend(parts)
+		self.pending += sum(map(len, parts))
+
+	def send(self, sk):
+		""" send the queued buffers to socket /sk/, in as few system calls as possible. return the number of bytes sent """
+		""" the buffers are gathered by one sendmsg() call without being joined. where sendmsg() is not available (Windows), they are joined and sent at once """
+		""" on a non-blocking socket, what the socket does not take now stays in the queue, and is sent first by the next call """
+		total = 0
+		while self.out:
+			batch = list(itertools.islice(self.out, SENDMSG_MAX))
+			try: n = sk.sendmsg(batch) if hasattr(sk, 'sendmsg') else sk.send(b''.join(batch))
+			except (BlockingIOError, InterruptedError): break # the socket buffer is full, try again later
+			self.writes += 1
+			total += n
+			full = n < sum(map(len, batch))
+			while n: # drop what has been sent, and cut the buffer sent in part
+				if len(self.out[0]) <= n: n -= len(self.out.popleft())
+				else:
+					self.out[0] = memoryview(self.out[0])[n:]
+					n = 0
+			if full: break
+		self.nsent += total
+		self.pending -= total
+		return total
+
+	def stats(self):
+		return { 'reads':self.reads, 'received':self.nbytes, 'frames':self.frames, 'beats':self.beats, 'failures':self.failures, 'resyncs':self.resyncs,
+				 'writes':self.writes, 'sent':self.nsent, 'pending':self.pending, 'skipped':self.skipped }
+
+	def find(self, marker):
+		""" index of the first /marker/ at or after /pos/, or -1. results are cached so that no byte is scanned twice for the same marker """
+		if self.found[marker] >= self.pos: return self.found[marker]
+		idx = self.buf.find( marker, max(self.pos, self.scanned[marker]), self.end )
+		self.found[marker] = idx
+		if idx == -1: self.scanned[marker] = max( self.pos, self.end - len(marker) + 1 )
+		return idx
+
+	def compact(self):
+		""" move the waiting bytes to the beginning of the buffer """
+		with memoryview(self.buf) as view: view[:self.end-self.pos] = view[self.pos:self.end]
+		for marker in self.found.keys():
+			self.found[marker] = self.found[marker] - self.pos if self.found[marker] >= self.pos else -1
+			self.scanned[marker] = max( self.scanned[marker] - self.pos, 0 )
+		self.end -= self.pos
+		self.pos = 0
+
+
+class FrameQueue():
+	""" a bounded queue of received frames for one connection, thread-safe """
+	""" /overflow/ tells what happens when /maxlen/ frames are waiting: """
+	"""		'drop-oldest': the oldest frame is dropped to make room """
+	"""		'drop-newest': the new frame is dropped """
+	"""		'block': no frame is dropped. the owner stops reading the socket while the queue is full (see full()), so the sender is held back by TCP """
+
+	def __init__(self, maxlen=10000, overflow='drop-oldest'):
+		self.frames = collections.deque()
+		self.maxlen = maxlen
+		self.overflow = overflow
+		self.lock = threading.Lock()
+		self.resume = None	# called when a full queue gets room again, for owners that have to be told (see aiocommunication)
+
+		self.delivered = 0	# how many frames have been taken out of the queue
+		self.dropped = 0	# how many frames have been dropped, by overflow or by recv()
+		self.entered = 0	# how many frames have entered the queue
+		self.taken = 0		# how many frames have left the queue, delivered or dropped. frames leave in the order they entered, see tracing.Tracer
+
+	def __len__(self):
+		return len(self.frames)
+
+	def full(self):
+		return len(self.frames) >= self.maxlen
+
+	def put(self, datastring):
+		with self.lock:
+			if self.full() and self.overflow == 'drop-newest':
+				self.dropped += 1
+				return
+			if self.full() and self.overflow == 'drop-oldest':
+				self.frames.popleft()
+				self.dropped += 1
+				self.taken += 1
+			self.frames.append(datastring)
+			self.entered += 1
+
+	def extend(self, frames):
+		for datastring in frames: self.put(datastring)
+
+	def get(self):
+		""" take out the oldest frame, or None if the queue is empty """
+		with self.lock:
+			was_full = self.full()
+			datastring = self.frames.popleft() if self.frames else None
+			if datastring is not None:
+				self.delivered += 1
+				self.taken += 1
+		if was_full and self.resume: self.resume()
+		return datastring
+
+	def get_all(self):
+		""" take out all the frames, oldest first """
+		with self.lock:
+			was_full = self.full()
+			frames = list(self.frames)
+			self.frames.clear()
+			self.delivered += len(frames)
+			self.taken += len(frames)
+		if was_full and self.resume: self.resume()
+		return frames
+
+	def get_newest(self):
+		""" take out the newest frame and drop the others, or None if the queue is empty """
+		frames = self.get_all()
+		with self.lock:
+			self.delivered -= max(len(frames)-1, 0)
+			self.dropped += max(len(frames)-1, 0)
+		return frames[-1] if frames else None
+
+	def stats(self):
+		return { 'depth':len(self.frames), 'delivered':self.delivered, 'dropped':self.dropped }
 
 
 class Server():
 	""" the server of the communication """
+	""" all the sockets are owned by one thread, which waits on a selector for the events it needs: new connections, received data, """
+	""" sockets ready to take the data waiting to be sent, and the heartbeat period. the other methods only hand work to this thread and never touch a socket """
 
-	def __init__(self):
+	def __init__(self, checksum='sum', maxlen=10000, overflow='drop-oldest', maxout=4*2**20, port=8006, callback=None):
 		self.sk0 = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # main socket, only for accepting new connections, do not transfer data
-		self.sk0.bind(('', 8006))
+		self.sk0.bind(('', port))
 		self.sk0.listen()
+		self.sk0.setblocking(False)
 
 		self.addresses = {self.sk0: socket.gethostbyname(socket.gethostname())}
-		self.I_sockets = {self.sk0: []}	# byte packages received
-		self.O_sockets = {}	# byte packages waiting to be sent
-		self.I_streams = {}	# raw byte stream received
+		self.I_sockets = {}	# byte packages received, one FrameQueue for each client
+		self.O_frames = collections.deque()	# byte packages waiting to be queued by the loop thread: (client socket, datastring), the socket is None for a broadcast, the datastring is None to watch the socket again
+		self.I_streams = {}	# raw byte stream, one Framer for each client
 		self.last_time = {}	# time of the last receive
+		self.events = {}	# the selector events registered for each client, see watch()
+		self.beat_time = {}	# time the last heartbeat was sent to each client, until the client echoes it
+		self.rtt = {}		# round trip time of the last heartbeat echoed by each client
 
 		self.heartbeat = b'heartbeat'
 		self.framehead = b'framehead'
+		self.checksum = checksum # checksum mode of the frames sent to a new client, see CHECKSUMS and Framer
+		self.maxlen = maxlen # the size and the overflow policy of the queue of received frames of each client, see FrameQueue
+		self.overflow = overflow
+		self.maxout = maxout # a client with more than /maxout/ bytes waiting to be sent misses the broadcast frames, see send()
+		self.callback = callback # /callback/ takes a datastring and returns a datastring (or None) to be sent back. it is called in the loop thread, and the frame is not queued
+		self.wakeups = 0 # how many times the loop thread has woken up
+
+		self.selector = selectors.DefaultSelector()
+		self.selector.register(self.sk0, selectors.EVENT_READ)
+		self.waker, self.wakee = socket.socketpair() # a byte written to /waker/ wakes the loop thread up, see wake()
+		self.waker.setblocking(False)
+		self.wakee.setblocking(False)
+		self.selector.register(self.wakee, selectors.EVENT_READ)
 
 		print('Server', self.addresses[self.sk0], 'initiated')
 
-		self.timer = looptimer(1, self.detect, start=True) # detect starts as soon as the server is initiated
+		self.flag = True
+		self.thrd = threading.Thread(target=self.__loop, name='Server', daemon=True) # detect starts as soon as the server is initiated
+		self.thrd.start()
 
 ##### receive and send (main functional methods) #####
 	def recv(self):
 		""" return one frame of received data """
-		""" note: only one frame is returned and others are dumped. this may need modification! """
-		self.read()
-		for sk in self.I_sockets.keys():
-			while self.I_sockets[sk]: datastring = self.I_sockets[sk].pop(0) # only keep the newest frame and dump the others
-		try:	return datastring
-		except:	return None
+		""" note: only one frame is returned and others are dumped (and counted as dropped). use /recv_all/ to get every frame """
+		datastring = None
+		for queue in list(self.I_sockets.values()):
+			datastring = queue.get_newest() or datastring # only keep the newest frame and dump the others
+		return datastring
+
+	def recv_all(self):
+		""" return all the received frames, client by client, in the order of arrival """
+		return [ datastring for queue in list(self.I_sockets.values()) for datastring in queue.get_all() ]
 
 	def send(self, datastring):
 		""" send /datastring/ to all clients """
-		for sk in self.O_sockets.keys(): self.O_sockets[sk].append(datastring)
-		self.write()
+		self.O_frames.append( (None, datastring) )
+		self.wake()
 
 	def interact(self, func=None):
 		""" a collection of 'receive-process-send' operations """
 		""" this is better than /recv/ because all frames are processed by /func/ and no frame is dumped """
 		""" /func/ is the function to process the data, it should take a datastring as input and return a datastring (or None) as output """
-		self.read()
-		for sk in self.I_sockets.keys():
-			while self.I_sockets[sk]:
-				datastring = self.I_sockets[sk].pop(0)
+		answered = False
+		for sk, queue in list(self.I_sockets.items()):
+			while queue:
+				datastring = queue.get()
 				ans = self.testfunc(datastring) if not func else func(datastring)
-				if ans: self.O_sockets[sk].append(ans)
-		self.write()
+				if ans:
+					self.O_frames.append( (sk, ans) )
+					answered = True
+		if answered: self.wake()
+
+	def close(self):
+		""" stop the loop thread and close all connections """
+		if self.flag:
+			self.flag = False
+			self.wake()
+			self.thrd.join()
 ######################################################
 
+##### the loop thread #####
+	def __loop(self, interval=1):
+		deadline = time.monotonic()
+		while self.flag:
+			try:	ready = self.selector.select( max(deadline - time.monotonic(), 0) )
+			except Exception as ex:
+				print('\nException in Server loop =', repr(ex))
+				ready = []
+			for key, events in ready: # every event, stage() and detect() are guarded: this thread owns every client, it must not end on one error
+				sk = key.fileobj
+				try:
+					if sk is self.sk0:		self.accept()
+					elif sk is self.wakee:	self.wakee.recv(4096) # only wakes the loop up
+					else:
+						if events & selectors.EVENT_READ:	self.read(sk)
+						if events & selectors.EVENT_WRITE:	self.write(sk)
+				except Exception as ex: print('\nException in Server loop =', repr(ex))
+			self.wakeups += 1
+			try:	self.stage()
+			except Exception as ex: print('\nException in Server loop =', repr(ex))
+			if time.monotonic() >= deadline:
+				try:	self.detect()
+				except Exception as ex: print('\nException in Server loop =', repr(ex))
+				deadline = max( deadline + interval, time.monotonic() ) # periods that have been missed are skipped
+
+		for sk in list(self.I_sockets.keys()): self.remove(sk)
+		for sk in (self.sk0, self.waker, self.wakee): sk.close()
+		self.selector.close()
+
+	def wake(self):
+		""" wake the loop thread up, from any other thread """
+		try:	self.waker.send(b'\x00')
+		except (BlockingIOError, OSError): pass # the loop is already woken up (or closed)
+##########################
+
 ##### read and write #####
-	def read(self):
-		""" read data from clients. this is a lower level function than /recv/, do not call from outside  """
-		for sk in MySelect(self.I_sockets.keys(), 'r'):	# select out sockets that are ready for reading
-			if sk == self.sk0: self.add( *sk.accept() )	# accept new client connection
-			else:
-				try: datastring = sk.recv(1024)			# read message from old connections
-				except Exception as ex: self.remove(sk, ex) # if error occurs, dump this socket
+	def accept(self):
+		""" accept new client connections. this is a lower level function, do not call from outside """
+		while True:
+			try:	sk, address = self.sk0.accept()
+			except (BlockingIOError, InterruptedError): return
+			except OSError as ex: # e.g. EMFILE or ECONNABORTED, the listening socket goes on
+				print('\nException in accept =', repr(ex))
+				return
+			try:	self.add(sk, address)
+			except OSError as ex: # the connection is dropped before it is half set up
+				print('\nException in accept =', repr(ex))
+				self.remove(sk)
+
+	@profiled
+	def read(self, sk):
+		""" read data from client /sk/. this is a lower level function than /recv/, do not call from outside """
+		try: nbytes = self.I_streams[sk].recv(sk)	# read all the available raw bytes straight into the stream
+		except Exception as ex: self.remove(sk, ex) # if error occurs, dump this socket
+		else:
+			if nbytes:	self.decode(sk)			# process the raw bytes
+			elif nbytes == 0: self.remove(sk, ex='Disconnected') # the client has closed the connection
+
+	@profiled
+	def write(self, sk):
+		""" send the data waiting for client /sk/. this is a lower level function than /send/, do not call from outside """
+		try:	self.I_streams[sk].send(sk)	# all the pending frames in one system call, the rest waits until the socket is ready for writing
+		except Exception as ex:	self.remove(sk, ex)	# if error occurs, dump this socket
+		else:	self.watch(sk)
+
+	def stage(self):
+		""" frame the data handed by the other threads into the output queue of each client, in the order they were handed over, and send them """
+		""" a broadcast frame is encoded once for each checksum mode in use, and the same buffers are queued for every client, instead of being framed client by client """
+		""" a client that has more than /maxout/ bytes waiting (a slow or stalled reader) skips broadcast frames, so that it neither holds back the others nor grows without bound """
+		if not self.O_frames: return
+		touched = set()
+		while self.O_frames:
+			sk, datastring = self.O_frames.popleft()
+			if sk is not None:
+				if sk not in self.I_streams: continue
+				if datastring is None: self.watch(sk) # a blocked queue got room, read the socket again
 				else:
-					if datastring:
-						self.I_streams[sk] += datastring# simply add raw bytes to the stream, without any processing
-						self.decode(sk)					# process the raw bytes
-
-	def write(self):
-		""" send data to clients. this is a lower level function than /send/, do not call from outside  """
-		for sk in MySelect(self.O_sockets.keys(), 'w'):	# select out sockets that are ready for writing
-			try:
-				while self.O_sockets[sk]: sk.sendall( self.encode( self.O_sockets[sk].pop(0) ) )
-			except Exception as ex:	self.remove(sk, ex)	# if error occurs, dump this socket
+					self.I_streams[sk].put(datastring)
+					touched.add(sk)
+				continue
+			frames = {}
+			for sk, framer in self.I_streams.items():
+				if framer.pending > self.maxout:
+					framer.skipped += 1
+					continue
+				if framer.mode not in frames: frames[framer.mode] = framer.encode_parts(datastring)
+				framer.queue(*frames[framer.mode])
+				touched.add(sk)
+		for sk in touched: self.write(sk)
+
+	def watch(self, sk):
+		""" register the events to wait for on client /sk/: reading, unless its queue is blocked, and writing, while data are waiting to be sent """
+		if sk not in self.I_streams: return
+		events = ( 0 if self.blocked(self.I_sockets[sk]) else selectors.EVENT_READ ) | ( selectors.EVENT_WRITE if self.I_streams[sk].out else 0 )
+		registered = self.events.get(sk, 0)
+		if events == registered: return
+		if not events:			self.selector.unregister(sk)
+		elif not registered:	self.selector.register(sk, events)
+		else:					self.selector.modify(sk, events)
+		self.events[sk] = events
 ##########################
 
 ##### decode and encode #####
+	@profiled
 	def decode(self, sk):
 		""" extract data frame by frame from raw bytes """
 		self.last_time[sk] = time.time()  # decode is only called when stream is updated, meaning receive succeeded, thus update the time of the last receive
+		frames, beats = self.I_streams[sk].decode()	# heartbeats are simply skipped, the echo only measures the round trip time
+		if beats and sk in self.beat_time: self.rtt[sk] = time.monotonic() - self.beat_time.pop(sk)
+		if not self.callback:
+			self.I_sockets[sk].extend(frames)
+			self.watch(sk) # stop reading a blocked queue
+			return
+		for datastring in frames:
+			try:	ans = self.callback(datastring)
+			except Exception as ex: print('\nException in callback =', ex)
+			else:
+				if ans: self.I_streams[sk].put(ans)
+		if self.I_streams[sk].out: self.write(sk)
 
-		stream = self.I_streams[sk]							# /stream/ is a temporary container for data processing
-
-		while True:											# see self.encode() for the structure of the frame
-			len_st = len(stream)
-			idx_hd = len_st if (self.framehead not in stream) else stream.index(self.framehead)
-			idx_ht = len_st if (self.heartbeat not in stream) else stream.index(self.heartbeat)
-			idx = min(idx_hd, idx_ht)
-
-			if idx == len_st: break							# neither head nor heart in the stream, do nothing and break. (wait for the next receive in case framehead is truncated)
-			elif idx == idx_ht:	idx += len(self.heartbeat)	# heart in the stream, skip and continue
-			elif idx == idx_hd:								# head in the stream, read the package
-				i = idx + len(self.framehead) + 4
-				if len_st < i: break
-				len_dt, = unpack( 'I', stream[i-4 : i] )	# the length of the package, maximum 2^32-1 bytes
-				if len_st < len_dt + i + 8: break			# the whole package cannot fit in the stream, do nothing and continue (wait for the next receive)
-				
-				datastring = stream[i : i+len_dt]			# the whole package and the tail checksum are included in the stream, read the package
-				i += len_dt
-				checksum, = unpack( 'Q', stream[i : i+8] )	# 'Q' stands for long unsigned integer, takes 8 bytes
-				if checksum != sum(datastring):	idx += len(self.framehead)	# check failed, skip the head and continue
-				else:
-					self.I_sockets[sk].append(datastring)	# check succeeded, add the package to the package list
-					idx = i + 8								# continue from the last frame tail
-
-			stream = stream[idx:]							# dump the part that has already been processed. note: if idx>len(stream), stream become empty
-
-		self.I_streams[sk] = stream
-
-	def encode(self, datastring):
-		""" add head and tail to the frame so that it can be safely transferred """
+	def encode(self, datastring, sk):
+		""" add head and tail to the frame so that it can be safely transferred, in the checksum mode negotiated with client /sk/ """
 		if datastring == self.heartbeat: return datastring
-		else: return self.framehead + pack('I', len(datastring)) + datastring + pack('Q', sum(datastring))
+		else: return self.I_streams[sk].encode(datastring)
 #############################
 
 ##### add and remove #####
 	def add(self, sk, address):
 		""" when a new client is connected, allocate resources for it """
-		self.I_sockets[sk] = []
-		self.O_sockets[sk] = []
-		self.I_streams[sk] = b''
+		setup(sk)
+		self.I_sockets[sk] = FrameQueue(self.maxlen, self.overflow)
+		self.I_sockets[sk].resume = lambda: self.O_frames.append( (sk, None) ) or self.wake() # a blocked queue got room, the loop thread reads the socket again, see stage()
+		self.I_streams[sk] = Framer(self.framehead, self.heartbeat, self.checksum)
 		self.addresses[sk] = address
 		self.last_time[sk] = time.time()
-		print('\nConnected by', address, ', connection number', len(self.I_sockets) - 1)
+		self.watch(sk)
+		print('\nConnected by', address, ', connection number', len(self.I_sockets))
 
 	def remove(self, sk, ex=None):
 		""" when a client is disconnected, release the corresponding resources """
+		if self.events.pop(sk, 0): self.selector.unregister(sk)
 		try:	sk.close()
 		except:	pass
 		if ex:	print('\nException =', ex)
 		if sk in self.I_sockets.keys():	self.I_sockets.pop(sk)
-		if sk in self.O_sockets.keys():	self.O_sockets.pop(sk)
 		if sk in self.I_streams.keys(): self.I_streams.pop(sk)
-		if sk in self.addresses.keys():	print(self.addresses.pop(sk), 'removed, connection number', len(self.I_sockets)-1)
+		if sk in self.addresses.keys():	print(self.addresses.pop(sk), 'removed, connection number', len(self.I_sockets))
 		if sk in self.last_time.keys(): self.last_time.pop(sk)
+		self.beat_time.pop(sk, None)
+		self.rtt.pop(sk, None)
 ##########################
 
 ##### others #####
 	def detect(self, timeout=5):
-		""" runs iteratively in backstage, to check wether the clients are healthly connected """
-		self.read()
-		timeout_list = [ sk for sk in self.last_time.keys() if (time.time() - self.last_time[sk] > timeout) ]
+		""" runs every second in the loop thread, to check wether the clients are healthly connected """
+		timeout_list = [ sk for sk in self.last_time.keys() if (time.time() - self.last_time[sk] > timeout) and not self.blocked(self.I_sockets[sk]) ] # a blocked client is silent because it is not read
 		for sk in timeout_list: self.remove(sk, ex='Disconnected') # if a client is desconnected, remove it
-		for sk in self.O_sockets.keys(): self.O_sockets[sk].append(self.heartbeat) # generate heartbeat signal
-		self.write()
+		for sk in list(self.I_streams.keys()): # generate heartbeat signal
+			self.I_streams[sk].put(self.heartbeat)
+			self.beat_time.setdefault(sk, time.monotonic()) # a heartbeat not echoed yet keeps its time, so a slow client shows a long round trip
+			self.write(sk)
 
 	def get_connection_state(self):
 		""" wether the server is connected by at least one client """
-		return len(self.I_sockets) > 1
+		return len(self.I_sockets) > 0
+
+	def blocked(self, queue):
+		""" with the 'block' overflow policy, a socket is not read while its queue is full """
+		return queue.overflow == 'block' and queue.full()
+
+	def stats(self):
+		""" counters of the received frames and of the stream of every client, and the round trip time of the heartbeat """
+		return { '%s:%i'%self.addresses[sk]:{ **self.I_sockets[sk].stats(), **self.I_streams[sk].stats(), 'rtt':self.rtt.get(sk) } for sk in list(self.I_sockets.keys()) }
 
 	def testfunc(self, datastring):
 		""" this is just for debug """
@@ -204,16 +669,27 @@ class Server():
 
 
 
-
 class Client():
 	""" the client of the connection """
+	""" the socket and the stream are used under /lock/: they are read by the thread of the owner (e.g. Acquisition) and by detect() on the timer thread, and written by any thread that sends """
 
-	def __init__(self, serverIP='', start=False):
+	def __init__(self, serverIP='', start=False, checksum='sum', maxlen=10000, overflow='drop-oldest', port=8006, tracer=None):
 		self.serverIP = serverIP
+		self.port = port
+		self.tracer = tracer # stamps the frames received, see tracing.Tracer. None: not traced
+		self.read_time = 0.0
+		self.beat_time = None	# time the last heartbeat was received
+		self.beat_gap = None	# time between the last two heartbeats. the server sends one every second: a longer gap means a congested link or server
 		self.flag = False
 		self.address = socket.gethostbyname(socket.gethostname())
 		self.heartbeat = b'heartbeat'
 		self.framehead = b'framehead'
+		self.checksum = checksum # checksum mode of the frames sent at the beginning of a connection, see CHECKSUMS and Framer
+		self.I_stream = Framer(self.framehead, self.heartbeat, self.checksum)
+		self.maxlen = maxlen # the size and the overflow policy of the queue of received frames, see FrameQueue
+		self.overflow = overflow
+		self.I_socket = FrameQueue(maxlen, overflow)
+		self.lock = threading.RLock()
 		self.timer = looptimer(1, self.detect)
 		print("Client", self.address, "initiated\n")
 
@@ -229,16 +705,17 @@ class Client():
 				self.opening.start() # open the socket in a separate thread to avoid blocking
 	def __open_operation(self):
 		while self.flag and not self.is_opened(): # if self.close() called during opening, open abort
-			try: self.sk = socket.create_connection((self.serverIP, 8006), timeout=1)
+			try: self.sk = setup( socket.create_connection((self.serverIP, self.port), timeout=1) )
 			except Exception as ex:
 				print("Connection failed:", ex, ", waiting for reconnection...")
 				time.sleep(1)
 
 		if self.flag:
-			self.I_socket = []
-			self.O_socket = []
-			self.I_stream = b''
-			self.last_time = time.time()
+			with self.lock:
+				self.I_socket = FrameQueue(self.maxlen, self.overflow)
+				self.O_socket = []
+				self.I_stream = Framer(self.framehead, self.heartbeat, self.checksum)
+				self.last_time = time.time()
 			self.timer.start() # self.detect() runs immediately as timer starts, make sure all dependencies are initiated before
 			print("Server", self.serverIP, "connected!\n")
 		else:
@@ -259,11 +736,16 @@ class Client():
 ##### receive and send (main functional methods) #####
 	def recv(self):
 		""" return one frame of received data """
-		""" note: only the newest frame is returned and others are dumped. this may need modification! """
+		""" note: only the newest frame is returned and others are dumped (and counted as dropped). use /recv_all/ to get every frame """
 		self.read()
-		while self.I_socket: datastring = self.I_socket.pop(0)
-		try:	return datastring
-		except:	return None
+		return self.I_socket.get_newest()
+
+	def recv_all(self):
+		""" return all the received frames, in the order of arrival """
+		self.read()
+		frames = self.I_socket.get_all()
+		if self.tracer: self.tracer.take(self.I_socket.taken - len(frames), len(frames))
+		return frames
 
 	def send(self, datastring):
 		if self.is_opened(): self.O_socket.append(datastring)
@@ -275,79 +757,66 @@ class Client():
 		""" /func/ is the function to process the data, it should take a datastring as input and return a datastring (or None) as output """
 		self.read()
 		while self.I_socket:
-			datastring = self.I_socket.pop(0)
+			datastring = self.I_socket.get()
 			ans = self.testfunc(datastring) if not func else func(datastring)
 			if ans: self.O_socket.append(ans)
 		self.write()
 ######################################################
 
 ##### read and write #####
+	@profiled
 	def read(self):
 		""" receive data from the server. this is a lower level function than /recv/, do not call from outside """
-		for sk in MySelect([self.sk], 'r'):
-			try: datastring = sk.recv(1024)
-			except Exception as ex: pass
-			else:
-				if datastring:
-					self.I_stream += datastring # add raw bytes to the stream without any processing
-					self.decode() # process the raw bytes
+		with self.lock:
+			if self.blocked(): return
+			for sk in MySelect([self.sk], 'r'):
+				try: nbytes = self.I_stream.recv(sk) # read all the available raw bytes straight into the stream
+				except Exception as ex: self.restart(ex=ex) # e.g. reset by the server. the socket would stay readable, and a thread waiting on it would spin
+				else:
+					if nbytes:
+						if self.tracer: self.read_time = time.monotonic()
+						self.decode() # process the raw bytes
+						if self.heartbeat in self.O_socket: self.write() # echo the heartbeat at once, so that the server measures the round trip of the link
+					elif nbytes == 0: self.restart(ex='Disconnected') # the server has closed the connection, so get_connection_state() tells it at once
 
+	@profiled
 	def write(self):
 		""" send data to the server. this is a lower level function than /recv/, do not call from outside """
-		for sk in MySelect([self.sk], 'w'):
-			try:
-				while self.O_socket: sk.sendall(self.encode(self.O_socket.pop(0)))
-			except Exception as ex: pass
+		with self.lock:
+			for sk in MySelect([self.sk], 'w'):
+				try:
+					while self.O_socket: self.I_stream.put(self.O_socket.pop(0))
+					self.I_stream.send(sk) # all the pending frames in one system call, the rest waits for the next write
+				except Exception as ex: pass
 ##########################
 
 ##### decode and encode #####
+	@profiled
 	def decode(self):
 		""" extract data frame by frame from raw bytes """
 		self.last_time = time.time()  # decode is only called when stream is updated, meaning receive succeeded, thus update the time of the last receive
-
-		stream = self.I_stream							# /stream/ is a temporary container for data processing
-
-		while True:
-			len_st = len(stream)
-			idx_hd = len_st if (self.framehead not in stream) else stream.index(self.framehead)
-			idx_ht = len_st if (self.heartbeat not in stream) else stream.index(self.heartbeat)
-			idx = min(idx_hd, idx_ht)
-
-			if idx == len_st: break						# neither head nor heart is in the stream, do nothing and break. (wait for the next receive in case framehead is truncated)
-			elif idx == idx_ht:
-				self.O_socket.append(self.heartbeat)  	# heart in the stream, echo back. note: this is different from server
-				idx += len(self.heartbeat)
-			elif idx == idx_hd:							# head in the stream, read the package
-				i = idx + len(self.framehead) + 4
-				if len_st < i: break
-				len_dt, = unpack( 'I', stream[i-4: i] )	# the length of the package, maximum 2^32-1 bytes
-				if len_st < len_dt + i + 8:	break		# the whole package cannot fit in the stream, do nothing and continue (wait for the next receive)
-
-				datastring = stream[i: i+len_dt]		# the whole package (including the tail checksum) are included in the stream, read the package
-				i += len_dt
-				checksum, = unpack( 'Q', stream[i: i+8] )
-				if checksum != sum(datastring):
-					idx += len(self.framehead)			# check failed, skip the head and continue
-				else:
-					self.I_socket.append(datastring)	# check succeeded, add the package to the package list
-					idx = i + 8							# continue from the last frame tail
-
-			stream = stream[idx:]  						# dump the part that has already been processed. note: if idx>len(stream), stream become empty
-
-		self.I_stream = stream
+		frames, beats = self.I_stream.decode()
+		if beats:
+			now = time.monotonic()
+			if self.beat_time: self.beat_gap = now - self.beat_time
+			self.beat_time = now
+		if self.tracer: self.tracer.framed(self.I_socket.entered, len(frames), self.read_time)
+		self.I_socket.extend(frames)
+		self.O_socket += [self.heartbeat] * beats	# echo back every heartbeat. note: this is different from server
 
 	def encode(self, datastring):
-		""" add head and tail to the frame so that it can be safely transferred """
+		""" add head and tail to the frame so that it can be safely transferred, in the checksum mode negotiated with the server """
 		if datastring == self.heartbeat: return datastring
-		else: return self.framehead + pack('I', len(datastring)) + datastring + pack('Q', sum(datastring))
+		else: return self.I_stream.encode(datastring)
 #############################
 
 ##### others #####
 	def detect(self, timeout=3):
 		""" runs iteratively in backstage, to check wether the server is healthly connected """
-		self.read()
-		if time.time() - self.last_time > timeout: self.restart(ex='Disconnected') # if the server if disconnected, restart the whole connection
-		if self.heartbeat in self.O_socket:	self.write() # echo back the heartbeat signal
+		with self.lock: # not between a read and a decode of the owner thread
+			self.read()
+			if time.time() - self.last_time > timeout and not self.blocked(): self.restart(ex='Disconnected') # if the server if disconnected, restart the whole connection. a blocked server is silent because it is not read
+			if self.heartbeat in self.O_socket or self.I_stream.out: self.write() # echo back the heartbeat signal, and send what a full socket did not take
 
 	def is_opened(self):
 		try:	return self.sk.fileno() != -1
@@ -357,6 +826,23 @@ class Client():
 		""" check wether the connection is healthy """
 		return self.flag and self.is_opened()
 
+	def wait(self, timeout):
+		""" wait at most /timeout/ seconds until data arrive from the server, for a thread that reads continuously """
+		try:
+			if self.is_opened() and not self.blocked():
+				select.select([self.sk], [], [], timeout)
+				return
+		except (OSError, ValueError): pass # the socket is closed by another thread
+		time.sleep(timeout)
+
+	def blocked(self):
+		""" with the 'block' overflow policy, the socket is not read while the queue is full """
+		return self.I_socket.overflow == 'block' and self.I_socket.full()
+
+	def stats(self):
+		""" counters of the received frames and of the stream, and the gap between the heartbeats of the server """
+		return { **self.I_socket.stats(), **self.I_stream.stats(), 'heartbeat_gap':self.beat_gap }
+
 	def testfunc(self, datastring):
 		""" this is just for debug """
 		print(datastring.decode())
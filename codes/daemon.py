@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+""" receive and log the sensor data of the robot without the GUI, e.g. on a small onboard computer. run from the /codes/ directory: """
+"""		python daemon.py 192.168.1.10 --channels forc imu --output ../log/ --duration 3600 """
+""" with --share, the frames are also published in shared memory, and the GUI started by 'python main.py --shared' shows them without decoding anything itself """
+""" nothing of PyQt5 or pyqtgraph is imported. stop with Ctrl+C (or SIGTERM): the remaining buffers are written before exiting """
+""" with --metrics-log and --metrics-http, the counters of the acquisition are exported for monitoring scripts, see metrics.py """
+""" with --profile, the time spent in the hot paths is recorded, and SIGUSR2 writes the recent spans as a Chrome trace, see profiling.py """
+""" with --trace, the latency of every frame from the socket to the buffer is traced (see tracing.py): SIGUSR1 prints and dumps the histograms, as the exit does """
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+
+from protocol import SENSOR_CHANNELS
+from communication import Client, CHECKSUMS
+from acquisition import Acquisition
+from sharedring import SharedSensorRing
+from tracing import Tracer, STAGES
+from metrics import Metrics, JsonLines, MetricsServer
+from profiling import PROFILER
+
+
+def parse(argv=None):
+	parser = argparse.ArgumentParser(description='receive and log the sensor data of the robot without the GUI')
+	parser.add_argument('serverIP', help='IP address of the robot')
+	parser.add_argument('-c', '--channels', nargs='+', choices=[ key for bit, key, shape in SENSOR_CHANNELS ], default=None, help='channels to log, all of them by default')
+	parser.add_argument('-o', '--output', default='../log/', help='directory of the log files (default ../log/)')
+	parser.add_argument('-f', '--format', choices=['bin', 'txt'], default='bin', help='log file format (default bin), see sensorlog.py')
+	parser.add_argument('-d', '--duration', type=float, default=0, help='seconds to log, 0 for no limit (default)')
+	parser.add_argument('-s', '--status', type=float, default=10, help='seconds between two status lines, 0 for none (default 10)')
+	parser.add_argument('--share', nargs='?', const='uppercomputer_sensors', default=None, metavar='NAME', help='publish the frames in a shared sensor ring for the GUI (python main.py --shared NAME), see sharedring.py')
+	parser.add_argument('--checksum', choices=list(CHECKSUMS.keys()), default='sum', help='checksum mode of the frames sent to the robot (default sum)')
+	parser.add_argument('--overflow', choices=['block', 'drop-oldest', 'drop-newest'], default='block', help='what the receive queue does when it is full, e.g. while the disk stalls (default block: the robot is held back by TCP and no frame is lost; the drop policies lose log data), see FrameQueue')
+	parser.add_argument('--trace', action='store_true', help='trace the latency of every frame from the socket to the buffer, see tracing.py')
+	parser.add_argument('--metrics-log', default=None, metavar='FILE', help='append the metrics as one JSON line per --metrics-interval to FILE, - for the standard output')
+	parser.add_argument('--metrics-interval', type=float, default=1.0, help='seconds between two lines of --metrics-log (default 1)')
+	parser.add_argument('--metrics-http', default=None, metavar='ADDRESS', help='serve the metrics as JSON on 127.0.0.1:ADDRESS if it is a port, or on the Unix socket ADDRESS')
+	parser.add_argument('--profile', action='store_true', help='record the time spent in the hot paths, SIGUSR2 writes them as a Chrome trace, see profiling.py')
+	return parser.parse_args(argv)
+
+
+def status(acq, time0, cnt0):
+	""" one line of the connection state, the frames received and the frames dropped by the receive queue """
+	stats = acq.client.stats()
+	return '%s  %s  frames %i  (%.1f /s)  dropped %i' % ( time.strftime('%H:%M:%S'), 'connected' if acq.connected else 'disconnected',
+		acq.prot.cnt, (acq.prot.cnt-cnt0) / max(time.time()-time0, 1e-9), stats['dropped'] )
+
+
+def dump(tracer, output):
+	""" print the latency histograms, and write them next to the logs """
+	tracer.report()
+	tracer.dump( os.path.join(output, 'trace_%s.json' % time.strftime('%y%m%d%H%M%S', time.localtime())) )
+
+
+def dump_profile(output):
+	filename = os.path.join(output, 'profile_%s.json' % time.strftime('%y%m%d%H%M%S', time.localtime()))
+	print(filename, 'written,', PROFILER.dump(filename), 'spans')
+
+
+def main(argv=None):
+	args = parse(argv)
+	PROFILER.enabled = args.profile
+	ring = SharedSensorRing(args.share, create=True) if args.share else None
+	tracer = Tracer(STAGES[:STAGES.index('buffered')+1]) if args.trace else None # no figure here, the frames are complete once buffered
+	acq = Acquisition( Client(args.serverIP, checksum=args.checksum, overflow=args.overflow), decimation=0, filepath=args.output, channels=args.channels, logformat=args.format, publishers=[ring] if ring else (), tracer=tracer ) # no snapshot, the GUI reads the ring
+	acq.client.open()
+
+	metrics = Metrics()
+	metrics.register('acquisition', acq.stats)
+	if tracer: metrics.register('latency', tracer.summary)
+	exporters = ( [JsonLines(metrics, args.metrics_log, args.metrics_interval)] if args.metrics_log else [] ) + ( [MetricsServer(metrics, args.metrics_http)] if args.metrics_http else [] )
+
+	stop = threading.Event()
+	for signum in (signal.SIGINT, signal.SIGTERM): signal.signal(signum, lambda signum, frame: stop.set())
+	if tracer and hasattr(signal, 'SIGUSR1'): signal.signal(signal.SIGUSR1, lambda signum, frame: dump(tracer, args.output)) # not on Windows
+	if args.profile and hasattr(signal, 'SIGUSR2'): signal.signal(signal.SIGUSR2, lambda signum, frame: dump_profile(args.output))
+
+	time_end = time.time() + args.duration if args.duration else None
+	time0, cnt0 = time.time(), acq.prot.cnt
+	while True:
+		timeout = args.status if args.status else None # wait for the next status line, the end of /duration/, or a signal
+		if time_end: timeout = min( timeout or args.duration, max(time_end-time.time(), 0) )
+		if stop.wait(timeout) or ( time_end and time.time() >= time_end ): break
+		print( status(acq, time0, cnt0) )
+		time0, cnt0 = time.time(), acq.prot.cnt
+
+	for exporter in exporters: exporter.close()
+	acq.close() # the worker stops and the remaining buffers are written
+	acq.client.close()
+	if ring:
+		ring.beat(False)
+		ring.close() # not removed, a GUI may be reading it, and the next run goes on with it
+	if tracer: dump(tracer, args.output)
+	print('Logging over. Total %i frames heard.' % acq.prot.cnt)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
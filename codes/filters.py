@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+
+class MovingAverage():
+	""" average of the newest /size/ frames, kept as a running sum so that each update costs O(1) """
+
+	def __init__(self, shape, size=5):
+		self.size = size
+		self.window = np.zeros([size, *shape])	# the newest frames, in a ring
+		self.sum = np.zeros(shape)
+		self.cnt = 0	# how many frames are in the window
+		self.idx = 0	# index of the next frame in the ring
+		self.value = np.zeros(shape)
+
+	def update(self, x):
+		self.sum += x - self.window[self.idx]
+		self.window[self.idx] = x
+		self.idx = (self.idx+1) % self.size
+		self.cnt = min(self.cnt+1, self.size)
+		if self.idx == 0: self.sum = np.sum(self.window[:self.cnt], axis=0) # re-sum once per round to stop rounding errors from accumulating
+		self.value = self.sum / self.cnt
+		return self.value
+
+
+class ExponentialFilter():
+	""" exponential moving average, y += alpha * (x-y) """
+
+	def __init__(self, shape, alpha=0.2):
+		self.alpha = alpha
+		self.value = np.zeros(shape)
+		self.cnt = 0
+
+	def update(self, x):
+		self.value = x + 0. if not self.cnt else self.value + self.alpha * (x-self.value)
+		self.cnt += 1
+		return self.value
+
+
+class BiquadFilter():
+	""" second order Butterworth low-pass filter, in direct form II transposed """
+	""" /cutoff/ is the cut-off frequency divided by the sampling frequency of the frames, 0 < cutoff < 0.5 """
+
+	def __init__(self, shape, cutoff=0.1):
+		K = np.tan(np.pi*cutoff)
+		Q = 2**-0.5
+		norm = 1 / (1 + K/Q + K*K)
+		self.b0 = K * K * norm
+		self.b1 = 2 * self.b0
+		self.b2 = self.b0
+		self.a1 = 2 * (K*K - 1) * norm
+		self.a2 = (1 - K/Q + K*K) * norm
+
+		self.z1 = np.zeros(shape)
+		self.z2 = np.zeros(shape)
+		self.value = np.zeros(shape)
+		self.cnt = 0
+
+	def update(self, x):
+		if not self.cnt: # start from the steady state of the first frame, instead of rising from zero
+			self.z1 = x * (1-self.b0)
+			self.z2 = x * (self.b2-self.a2)
+		y = self.b0 * x + self.z1
+		self.z1 = self.b1 * x - self.a1 * y + self.z2
+		self.z2 = self.b2 * x - self.a2 * y
+		self.value = y
+		self.cnt += 1
+		return self.value
+
+
+FILTERS = { 'mean':MovingAverage, 'exp':ExponentialFilter, 'biquad':BiquadFilter }
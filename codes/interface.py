@@ -1,12 +1,20 @@
 # -*- coding: utf-8 -*-
+import time
 from PyQt5 import QtWidgets as QW
 from PyQt5 import QtCore as QC
+from PyQt5 import QtGui as QG
 from PyQt5.QtCore import pyqtSlot
 
 from uifiles import interface_Main
 from uifiles import interface_PoseParam
 from protocol import Protocol, SensorPackage, ParameterPackage
 from communication import Client
+from acquisition import Acquisition, SharedAcquisition
+from sharedring import SharedSensorRing
+from tracing import Tracer
+from metrics import Metrics, JsonLines, MetricsServer, flatten
+from profiling import PROFILER, profiled
+from render import RenderScheduler
 
 
 class DialogPose(QW.QDialog, interface_PoseParam.Ui_Dialog):
@@ -82,7 +90,13 @@ class DialogPose(QW.QDialog, interface_PoseParam.Ui_Dialog):
 
 
 class MainWindow(QW.QMainWindow, interface_Main.Ui_MainWindow):
-	def __init__(self):
+	""" /shared/ is the name of a shared sensor ring: the data are then received and logged by another process (python daemon.py serverIP --share), and only shown here """
+	""" either process may be restarted without the other. the client of the window is then only used to send commands, and drops the frames it receives """
+	""" /tap/ is the name of a shared sensor ring, in which the frames received here are published for analysis scripts on the same machine, see sharedring.py """
+	""" with /trace/, the latency of every frame from the socket to the figures is traced (see tracing.py), and Ctrl+T prints and dumps the histograms """
+	""" the metrics (see metrics.py) are shown in a status panel, toggled by Ctrl+M, and exported to /metrics_log/ and /metrics_http/ if given """
+	""" with /profile/, the time spent in the hot paths is recorded (see profiling.py), and Ctrl+P writes the recent spans as a Chrome trace """
+	def __init__(self, shared=None, tap=None, trace=False, metrics_log=None, metrics_http=None, profile=False):
 		super(QW.QMainWindow, self).__init__()
 		self.setupUi(self)
 
@@ -94,29 +108,66 @@ class MainWindow(QW.QMainWindow, interface_Main.Ui_MainWindow):
 			if key[-1] == 'K': self.widget_5.figs[key].setTitle(key[:2]+'Z')
 
 		# set up attributes
-		self.client = Client()
+		self.tracer = Tracer() if trace and not shared else None # the frames received by another process cannot be traced here
+		if shared:
+			self.acq = SharedAcquisition(shared) # receives and decodes in another process
+			self.client = Client(maxlen=1)
+		else:
+			self.tap = SharedSensorRing(tap, create=True) if tap else None
+			self.acq = Acquisition(publishers=[self.tap] if tap else (), tracer=self.tracer) # receives and decodes in a separate thread, see acquisition.py
+			self.client = self.acq.client
+		self.prot = Protocol() # collects the commands and parameters sent. not self.acq.prot, whose fields are changed by every frame decoded in the acquisition thread
 		self.connected = False
+		self.shown_cnt = 0 # the frame count of the last snapshot shown
 
 		self.dialpose = DialogPose()
 		self.dialpose.accepted.connect(self.on_dialpose_accepted)
 
-		self.prot = Protocol()
-		self.sens = self.prot.sens
 		self.stat = self.prot.stat
 		self.comd = self.prot.comd
 		self.para = self.prot.para
-		self.datashow = SensorPackage(buflen_max=25)
+		self.datashow = SensorPackage(buflen_max=25, ring=True)
+
+		# the figures are refreshed at a steady rate by self.render, only when they are visible and have new data, see render.py
+		# meter figures are refreshed on every tick to look smooth, the time-consuming curve figures on every other tick, staggered with them
+		shown = lambda: self.isVisible() and not self.isMinimized()
+		self.render = RenderScheduler(fps=25)
+		self.render.add('meters', self.update_figure_2, visible=lambda: shown() and self.tabWidget_2.currentIndex() == 0, key=self.tabWidget_2.currentIndex)
+		self.render.add('curves', self.update_figure_1, visible=shown, key=self.tabWidget.currentIndex, every=2)
 
 
 		# set up timers
 		self.timer0 = QC.QTimer() # Check connection state
-		self.timer1 = QC.QTimer() # Communication (receive data)
+		self.timer1 = QC.QTimer() # take the data received by self.acq into the figure data
+		self.timer2 = QC.QTimer() # refresh the figures, at the interval of self.render
 
 		self.timer0.timeout.connect(self.checkConnection)
 		self.timer1.timeout.connect(self.hear)
+		self.timer2.timeout.connect(self.paint)
 
 		self.timer0.start(1000) # check connection state every 1 second, start as soon as the UI is launched
 		self.timer1.setInterval(40)
+		self.timer2.setInterval( round(self.render.interval * 1000) )
+
+		if self.tracer: QW.QShortcut(QG.QKeySequence('Ctrl+T'), self, self.dumpTrace)
+		PROFILER.enabled = profile
+		if profile: QW.QShortcut(QG.QKeySequence('Ctrl+P'), self, self.dumpProfile)
+
+		# set up metrics, and the status panel showing them
+		self.metrics = Metrics()
+		self.metrics.register('acquisition', self.acq.stats)
+		self.metrics.register('gui', self.stats)
+		if self.tracer: self.metrics.register('latency', self.tracer.summary)
+		self.exporters = ( [JsonLines(self.metrics, metrics_log)] if metrics_log else [] ) + ( [MetricsServer(self.metrics, metrics_http)] if metrics_http else [] )
+
+		self.status = QW.QPlainTextEdit()
+		self.status.setReadOnly(True)
+		self.status.setFont(QG.QFontDatabase.systemFont(QG.QFontDatabase.FixedFont))
+		self.dock_status = QW.QDockWidget('Status', self)
+		self.dock_status.setWidget(self.status)
+		self.addDockWidget(QC.Qt.RightDockWidgetArea, self.dock_status)
+		self.dock_status.hide()
+		QW.QShortcut(QG.QKeySequence('Ctrl+M'), self, lambda: self.dock_status.setVisible(not self.dock_status.isVisible()))
 
 ########## set up slots ##########
 
@@ -162,46 +213,83 @@ class MainWindow(QW.QMainWindow, interface_Main.Ui_MainWindow):
 ##### figure tab #####
 	@pyqtSlot(int)
 	def on_tabWidget_currentChanged(self):
-		self.update_figure_1()
+		self.render.show('curves')
 	@pyqtSlot(int)
 	def on_tabWidget_2_currentChanged(self):
-		self.update_figure_2()
+		self.render.show('meters')
 ######################
 
 
 ########## other methods ##########
 
+	def closeEvent(self, event):
+		""" make sure the logs are completely written before the window is closed """
+		for exporter in self.exporters: exporter.close()
+		self.acq.close()
+		super(QW.QMainWindow, self).closeEvent(event)
+
 	def checkConnection(self):
-		connected = self.client.get_connection_state()
+		""" the connection itself (new log files, flushing the logs) is followed by self.acq, only the UI is updated here """
+		connected = self.acq.connected
 		connection_changed = self.connected != connected
 		self.connected = connected
+		if self.dock_status.isVisible(): self.update_status()
 
 		if connection_changed and connected:
-			self.sens = self.prot.sens = SensorPackage() # if reconnected, new log files are created and old buffers are dumped
+			self.acq.take() # dump the snapshots of the last connection
 			self.timer1.start()
-			print("Start hearing ...")
+			self.timer2.start()
 			self.label_9.setText('Connected')
 		elif connection_changed and not connected:
 			self.timer1.stop()
-			print("Hearing over. Total %i frames heard."%self.prot.cnt)
+			self.timer2.stop()
 			self.label_9.setText('Disconnected')
 
+	@profiled
 	def hear(self):
-		last_cnt = self.prot.cnt
-		# self.client.interact(self.prot.process)	# this do not dump any frame
-		self.prot.distrib(self.client.recv())	# this returns the newest frame and dump the others
-		if self.prot.cnt > last_cnt:
-			if self.prot.cnt % 5 == 0:	self.update_figdata()	# set different update frequencies and phases to stagger these time-consuming operations
-			if self.prot.cnt % 5 == 1:	self.update_figure_2()	# meter figures should update more frequently to look smooth
-			if self.prot.cnt % 15== 3:	self.update_figure_1()
-
-	def update_figdata(self):
-		""" update figure data (only data, not figure) """
-		if not self.sens.checkBufferEmpty():
-			self.datashow.decode('copy', datacopy=self.sens.filter())
-			if self.datashow.checkBufferFull():	self.datashow.bufferShift()
-			self.datashow.bufferIn()
-
+		""" the frames are decoded and logged by self.acq in its own thread. here the snapshots it published are added to the figure data, which paint() shows """
+		snapshots = self.acq.take()
+		if not snapshots: return
+		for cnt, data in snapshots: self.update_figdata(data)
+		self.shown_cnt = cnt
+		if self.tracer: self.tracer.stamp('figdata', upto=cnt)
+		self.render.mark()
+
+	def paint(self):
+		""" refresh the figures due, and follow the refresh interval adapted by self.render to the time they take """
+		if self.render.tick() and self.tracer: self.tracer.stamp('painted')	# the widgets have their new data, Qt repaints them as soon as the event loop runs
+		interval = round(self.render.interval * 1000)
+		if interval != self.timer2.interval(): self.timer2.setInterval(interval)
+
+	def stats(self):
+		""" the frames shown, the refresh rate and time of the figures, and the commands sent, see metrics.py """
+		return { 'shown':self.shown_cnt, 'render':self.render.stats(), 'sent':self.prot.stats()['out'] }
+
+	def update_status(self):
+		""" show the metrics in the status panel, one per line """
+		text = lambda value: '%.4g'%value if isinstance(value, float) else str(value)
+		lines = [ '%-40s %s'%(key, text(value)) for key, value in flatten(self.metrics.collect()).items() if key != 'time' ]
+		self.status.setPlainText('\n'.join(lines))
+
+	def dumpTrace(self):
+		""" print the latency histograms, and write them next to the logs """
+		self.tracer.report()
+		filename = '../log/trace_%s.json' % time.strftime('%y%m%d%H%M%S', time.localtime())
+		self.tracer.dump(filename)
+		print(filename, 'written')
+
+	def dumpProfile(self):
+		""" write the recent spans next to the logs, to be opened in chrome://tracing or ui.perfetto.dev """
+		filename = '../log/profile_%s.json' % time.strftime('%y%m%d%H%M%S', time.localtime())
+		print(filename, 'written,', PROFILER.dump(filename), 'spans')
+
+	def update_figdata(self, data):
+		""" update figure data (only data, not figure) with a snapshot of the filtered sensor data """
+		self.datashow.decode('copy', datacopy=data)
+		if self.datashow.checkBufferFull():	self.datashow.bufferShift()
+		self.datashow.bufferIn()
+
+	@profiled
 	def update_figure_1(self):
 		""" refresh curve figures """
 		if not self.datashow.checkBufferEmpty():
@@ -211,6 +299,7 @@ class MainWindow(QW.QMainWindow, interface_Main.Ui_MainWindow):
 			elif idx == 1:	self.widget_4.update(buf['disp_time'], buf['disp'])
 			elif idx == 2:	self.widget_5.update(buf['foot_time'], buf['foot'])
 
+	@profiled
 	def update_figure_2(self):
 		""" refresh meter figures """
 		if not self.datashow.checkBufferEmpty():
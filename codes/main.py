@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import sys
+import signal
+import argparse
 from PyQt5 import QtWidgets as QW
 from interface import MainWindow
 
@@ -9,9 +11,19 @@ from interface import MainWindow
 
 if __name__=="__main__":
 	
-	app = QW.QApplication(sys.argv)
-
-	mainwin = MainWindow()
+	parser = argparse.ArgumentParser(description='the upper computer of the quadruped robot')
+	parser.add_argument('--shared', nargs='?', const='uppercomputer_sensors', default=None, metavar='NAME', help='show the data published by another process (python daemon.py serverIP --share NAME) instead of receiving them')
+	parser.add_argument('--tap', nargs='?', const='uppercomputer_sensors', default=None, metavar='NAME', help='publish the data received in shared memory for analysis scripts, see sharedring.py')
+	parser.add_argument('--trace', action='store_true', help='trace the latency of every frame from the socket to the figures, Ctrl+T dumps the histograms, see tracing.py')
+	parser.add_argument('--metrics-log', default=None, metavar='FILE', help='append the metrics as one JSON line per second to FILE, - for the standard output, see metrics.py')
+	parser.add_argument('--metrics-http', default=None, metavar='ADDRESS', help='serve the metrics as JSON on 127.0.0.1:ADDRESS if it is a port, or on the Unix socket ADDRESS')
+	parser.add_argument('--profile', action='store_true', help='record the time spent in the hot paths, Ctrl+P or SIGUSR2 writes them as a Chrome trace, see profiling.py')
+	args, qtargs = parser.parse_known_args() # the other arguments are for Qt
+
+	app = QW.QApplication(sys.argv[:1] + qtargs)
+
+	mainwin = MainWindow(shared=args.shared, tap=args.tap, trace=args.trace, metrics_log=args.metrics_log, metrics_http=args.metrics_http, profile=args.profile)
+	if args.profile and hasattr(signal, 'SIGUSR2'): signal.signal(signal.SIGUSR2, lambda signum, frame: mainwin.dumpProfile()) # run by the interpreter between two Qt events, not on Windows
 
 	mainwin.show()
 
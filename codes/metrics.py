@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+""" runtime metrics of the upper computer, for the status panel of the GUI and for monitoring scripts: """
+"""		python daemon.py 192.168.1.10 --metrics-log ../log/metrics.jsonl --metrics-http 8090 """
+"""		curl http://127.0.0.1:8090/metrics """
+""" the counters stay where they are counted (the stats() methods of Client, Framer, Protocol, LogWriter, ...), the registry only reads them when asked """
+import os
+import sys
+import json
+import time
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler
+
+from communication import looptimer
+
+
+class Metrics():
+	""" a registry of metric sources: every source is a function returning a dict, usually a stats() method, called when the metrics are collected """
+
+	def __init__(self):
+		self.sources = {}
+		self.lock = threading.Lock()
+
+	def register(self, name, func):
+		with self.lock: self.sources[name] = func
+
+	def unregister(self, name):
+		with self.lock: self.sources.pop(name, None)
+
+	def collect(self):
+		""" { 'time':unix time, name:what its source returns }. a source that fails gives { 'error':message } instead of stopping the others """
+		with self.lock: sources = list(self.sources.items())
+		metrics = { 'time':time.time() }
+		for name, func in sources:
+			try:	metrics[name] = func()
+			except Exception as ex: metrics[name] = { 'error':repr(ex) }
+		return metrics
+
+	def json(self):
+		return json.dumps(self.collect(), default=str)
+
+
+def flatten(metrics, prefix=''):
+	""" the nested dicts of collect() as one level, { 'acquisition.client.dropped':0, ... } """
+	flat = {}
+	for key, value in metrics.items():
+		if isinstance(value, dict):	flat.update( flatten(value, '%s%s.'%(prefix, key)) )
+		else:						flat['%s%s'%(prefix, key)] = value
+	return flat
+
+
+class JsonLines():
+	""" append the metrics as one JSON line every /interval/ seconds to /filename/ ('-' for the standard output), on the shared timer thread """
+
+	def __init__(self, metrics, filename='-', interval=1.0):
+		self.metrics = metrics
+		if filename == '-':	self.file = sys.stdout
+		else:
+			if os.path.dirname(filename): os.makedirs(os.path.dirname(filename), exist_ok=True)
+			self.file = open(filename, 'a')
+		self.lock = threading.Lock() # close() waits for a write() running on the timer thread
+		self.timer = looptimer(interval, self.write, start=True)
+
+	def write(self):
+		line = self.metrics.json() + '\n'
+		with self.lock:
+			if self.file is None: return # closed while the metrics were collected
+			self.file.write(line)
+			self.file.flush()
+
+	def close(self):
+		self.timer.stop()
+		with self.lock:
+			if self.file not in (None, sys.stdout): self.file.close()
+			self.file = None
+
+
+class MetricsServer():
+	""" serve the metrics as JSON to GET /metrics (any path) on a local endpoint, in a separate thread """
+	""" /address/ is a port number, served on 127.0.0.1 only, or (host, port), or the path of a Unix socket: curl --unix-socket PATH http://localhost/metrics """
+
+	def __init__(self, metrics, address=8090):
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = metrics.json().encode()
+				self.send_response(200)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+			def log_message(self, *args): pass # no line per request
+			def address_string(self): return str(self.client_address) # a Unix socket has no host
+
+		self.address = address
+		self.unix = isinstance(address, str) and not address.isdigit()
+		if self.unix:
+			if os.path.exists(address): os.remove(address) # left by a previous run
+			self.server = socketserver.ThreadingUnixStreamServer(address, Handler, bind_and_activate=False)
+		else:
+			self.server = socketserver.ThreadingTCPServer(address if isinstance(address, tuple) else ('127.0.0.1', int(address)), Handler, bind_and_activate=False)
+		self.server.allow_reuse_address = True # the port can be taken again as soon as a previous run exits
+		self.server.daemon_threads = True
+		self.server.server_bind()
+		self.server.server_activate()
+		self.thrd = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thrd.start()
+
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+		if self.unix: os.remove(self.address)
@@ -2,6 +2,8 @@ import numpy as np
 import pyqtgraph as pg
 from PyQt5 import QtCore as QC
 
+from profiling import profiled
+
 
 class DynamicGraphWidget_curves(pg.GraphicsLayoutWidget):
 	""" draw 12 figures on the widget """
@@ -34,6 +36,7 @@ class DynamicGraphWidget_curves(pg.GraphicsLayoutWidget):
 			self.crvs[key] = fig.plot([], [])
 			self.refs[key] = fig.plot([], [], pen={'style':QC.Qt.DotLine})
 
+	@profiled
 	def update(self, time, data, ref_time=[], ref_data=[]):
 		x1, x2, ran = np.min(time), np.max(time), self.ran
 		xRange = (x1, x1+ran) if (x2-x1<ran) else (x2-ran, x2)
@@ -72,6 +75,7 @@ class DynamicGraphWidget_angle(pg.GraphicsLayoutWidget):
 			crv = self.fig.plot(x, y)
 			crv.setPen(style=QC.Qt.DotLine)
 
+	@profiled
 	def update(self, yaw, pitch, roll):
 		""" IMU data defined as follows: """
 		""" coordinate: x -> front, y -> left, z -> up """
@@ -104,6 +108,7 @@ class DynamicGraphWidget_angle(pg.GraphicsLayoutWidget):
 class DynamicGraphWidget_veloc(pg.GraphicsLayoutWidget):
 	def __init__(self, parent=None):
 		super(DynamicGraphWidget_veloc, self).__init__(parent)
+	@profiled
 	def update(self, yaw, pitch, roll):
 		pass
 
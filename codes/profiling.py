@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+""" span profiling of the hot paths, to find what makes the GUI stutter: the disk, the figures, or the sockets """
+""" a span is the time spent in a function decorated by @profiled, or in a 'with PROFILER.span(name)' block. the most recent spans are kept in a ring, """
+""" and dump() writes them in the Chrome trace event format, to be opened in chrome://tracing or https://ui.perfetto.dev as a timeline per thread """
+""" profiling is off unless PROFILER.enabled is set (python main.py --profile, python daemon.py --profile): a decorated function then only tests this flag """
+import os
+import json
+import time
+import functools
+import threading
+import collections
+
+
+class Profiler():
+	""" the ring of the /maxlen/ most recent spans: (name, thread ident, start, duration), in nanoseconds of time.perf_counter_ns() """
+	""" spans are appended from any thread, deque.append is atomic """
+
+	def __init__(self, maxlen=200000):
+		self.enabled = False
+		self.spans = collections.deque(maxlen=maxlen)
+
+	def add(self, name, start):
+		""" a span of /name/ from /start/ (perf_counter_ns) to now, in the current thread """
+		self.spans.append( (name, threading.get_ident(), start, time.perf_counter_ns() - start) )
+
+	def span(self, name):
+		""" a context manager timing its block as a span of /name/ """
+		return Span(self, name) if self.enabled else NOSPAN
+
+	def events(self):
+		""" the spans in the Chrome trace event format: complete events ('X') in microseconds, and the names of the threads ('M') """
+		spans = list(self.spans)
+		pid = os.getpid()
+		names = { thrd.ident:thrd.name for thrd in threading.enumerate() }
+		events = [ { 'name':'thread_name', 'ph':'M', 'pid':pid, 'tid':tid, 'args':{ 'name':names.get(tid, str(tid)) } } for tid in set( span[1] for span in spans ) ]
+		events += [ { 'name':name, 'ph':'X', 'pid':pid, 'tid':tid, 'ts':start / 1e3, 'dur':duration / 1e3 } for name, tid, start, duration in spans ]
+		return events
+
+	def dump(self, filename):
+		""" write the spans to /filename/ as a Chrome trace. the ring is kept, so that the next dump overlaps this one """
+		if os.path.dirname(filename): os.makedirs(os.path.dirname(filename), exist_ok=True)
+		events = self.events()
+		with open(filename, 'w') as f: json.dump({ 'traceEvents':events, 'displayTimeUnit':'ms' }, f)
+		return sum( event['ph'] == 'X' for event in events ) # the spans written
+
+
+class Span():
+	def __init__(self, profiler, name):
+		self.profiler = profiler
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.perf_counter_ns()
+
+	def __exit__(self, *exc):
+		self.profiler.add(self.name, self.start)
+
+
+class NoSpan():
+	""" the span given while profiling is off, which does nothing """
+	def __enter__(self): pass
+	def __exit__(self, *exc): pass
+
+
+NOSPAN = NoSpan()
+PROFILER = Profiler() # the hot paths of every module record into this profiler
+
+
+def profiled(func):
+	""" decorator: every call of /func/ is a span named after it, while PROFILER is enabled """
+	name = func.__qualname__
+	@functools.wraps(func)
+	def wrapper(*args, **kwargs):
+		if not PROFILER.enabled: return func(*args, **kwargs)
+		start = time.perf_counter_ns()
+		try:		return func(*args, **kwargs)
+		finally:	PROFILER.add(name, start)
+	return wrapper
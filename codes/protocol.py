@@ -2,12 +2,34 @@
 import numpy as np
 import time
 import os
+import collections
 from struct import pack, unpack
 
+from sensorlog import SensorLog, LogWriter
+from filters import FILTERS
+from profiling import profiled
+
+
+# layout of the sensor package body. every channel is a float32 time stamp followed by float32 data, and is present only if its bit is set in the flag byte
+SENSOR_CHANNELS = ( (0x01, 'forc', (4,3)), (0x02, 'disp', (4,3)), (0x04, 'foot', (4,3)), (0x08, 'imu', (3,3)) )
+
+# the package types of the protocol header, see Protocol
+PACKAGE_TYPES = { 0x01:'sensor', 0x02:'state', 0x03:'command', 0x04:'parameter' }
+
+def sensor_layout(flag, with_flag=False):
+	""" build the numpy structured dtype of the sensor package body for a given /flag/. the flag byte is excluded unless /with_flag/ is True """
+	fields = [ ('flag', 'u1') ] if with_flag else []
+	for bit, key, shape in SENSOR_CHANNELS:
+		if flag & bit: fields += [ (key+'_time', 'f4'), (key, 'f4', shape) ]
+	return np.dtype(fields)
+
+SENSOR_LAYOUTS = { flag:sensor_layout(flag) for flag in range(16) } # precompiled layouts, keyed by the flag byte (only the lower 4 bits are used)
+SENSOR_FRAMES  = { flag:sensor_layout(flag, with_flag=True) for flag in range(16) } # the same layouts with the flag byte included, for batch decode
+
 
 class SensorPackage():
 
-	def __init__(self, buflen_max=500):
+	def __init__(self, buflen_max=500, logformat='bin', ring=False, filepath='../log/', channels=None, publishers=()):
 
 		# data dictionary. store 1 frame of data and their conrresponding time (time is also treated as data)
 		self.data = {
@@ -22,24 +44,91 @@ class SensorPackage():
 
 		# mark which term is updated and should be added into data buffer
 		self.bufinflag = { key:False for key in self.data.keys() } # bufferIn() and encode() will set all bufinflags to False
+		self.time_keys = [ key for key in self.data.keys() if 'time' in key ]
 
 		# data buffer, store every frame of data up to a maximum length, for file writing
 		self.buflen_max = buflen_max
 		self.buflen = { key:0 for key in self.data.keys() } # keep track on the length of every term in dictionary. This length is also the index of the next element to be added
 		self.data_buf = { key:np.zeros([self.buflen_max, *np.shape(self.data[key])]) for key in self.data.keys() } # this is equivalent to: self.data_buf = { 'forc': np.zeros([self.buflen_max,4,3]), ... }
 
-		# record all received data in local files, named by local time
+		# ring buffer mode, for dynamic figure data. the buffer keeps the newest /buflen_max/ frames and is never written to the log files
+		# every frame is stored twice, at /head/ and /head+buflen_max/, so that the valid frames in order are always a contiguous slice (see bufferView)
+		self.ring = ring
+		self.head = { key:0 for key in self.data.keys() } # index of the next element to be added in ring mode
+		if ring: self.data_buf = { key:np.zeros([2*self.buflen_max, *np.shape(self.data[key])]) for key in self.data.keys() }
+
+		# incremental filters (see setFilter), updated in bufferIn. if not set, filter() averages the buffer on every call
+		self.filters = None
+
+		# record all received data in local files under /filepath/, named by local time. the directory is created when the first buffer is written
+		# /logformat/ is 'bin' for the binary format of sensorlog.py, or 'txt' for the old '%.18e' text format
+		# binary data are stored as float32 as on the wire, time stamps as float64 so that local time (see test()) is not truncated
+		# /channels/ lists the channels to be logged (e.g. ['forc', 'imu']), all of them by default. the others are still decoded and buffered
 		file_prefix = time.strftime("%y%m%d%H%M%S", time.localtime())
-		self.filenames = { key:'log_%s_%s.txt'%(file_prefix, key) for key in  self.data.keys()}
-		self.filepath = '../log/'
-		if not os.path.exists(self.filepath): os.mkdir(self.filepath)
+		self.logformat = logformat
+		self.filenames = { key:'log_%s_%s.%s'%(file_prefix, key, logformat) for key in  self.data.keys()}
+		self.filepath = filepath
+		logged = [ key for key in self.data.keys() if channels is None or key.replace('_time', '') in channels ]
+		self.logs = { key:SensorLog(os.path.join(self.filepath, self.filenames[key]), key, np.shape(self.data[key]), '<f8' if key in self.time_keys else '<f4', logformat) for key in logged }
+
+		# full buffers are written by a background thread (created at the first bufferOut). while a buffer is being written, a spare one takes its place
+		self.writer = None
+		self.spare_buf = { key:[] for key in self.data.keys() } # buffers returned by the writer, ready to be reused
+
+		# every frame decoded is also handed to the publishers, e.g. sharedring.SharedSensorRing, by publisher.publish(frames)
+		# /frames/ is a structured array of SENSOR_FRAMES, only valid during the call
+		self.publishers = publishers
 
 	def process(self, datastring):
 		if not self.checkDataString(datastring): return
 		self.decode(datastring)
+		if self.publishers and type(datastring) == bytes and datastring != b'test':
+			for publisher in self.publishers: publisher.publish( np.frombuffer(datastring, dtype=SENSOR_FRAMES[datastring[0] & 0x0F]) )
 		if self.checkBufferFull(): self.bufferOut()
 		self.bufferIn()
 
+	def process_many(self, datastrings):
+		""" process a batch of frames. consecutive frames with the same flag are decoded by one np.frombuffer call and put into the buffer in bulk """
+		""" the result is the same as calling /process/ on every frame in order """
+		run, run_flag = [], None
+		for datastring in datastrings:
+			if not self.checkDataString(datastring): continue
+			flag = None if datastring == b'test' else datastring[0] & 0x0F
+			if run and flag != run_flag:
+				self.processRun(run, run_flag)
+				run = []
+			if flag is None: self.process(datastring)
+			else: run.append(datastring)
+			run_flag = flag
+		if run: self.processRun(run, run_flag)
+
+	def processRun(self, datastrings, flag):
+		""" decode a list of frames sharing the same /flag/ and add them to the buffer """
+		frames = np.frombuffer(b''.join(datastrings), dtype=SENSOR_FRAMES[flag])
+		keys = SENSOR_LAYOUTS[flag].names
+		for publisher in self.publishers: publisher.publish(frames)
+
+		for key in keys: # the newest frame stays in /data/, as if the frames were processed one by one
+			if key in self.time_keys:	self.data[key] = float(frames[-1][key])
+			else:						self.data[key][:] = frames[-1][key]
+
+		if self.filters:
+			for key in keys:
+				for x in frames[key]: self.filters[key].update(x)
+
+		if self.ring:
+			for key in keys: self.ringIn(key, frames[key])
+			return
+
+		i = 0
+		while i < len(frames):
+			if self.checkBufferFull(): self.bufferOut()
+			n = min( [len(frames)-i] + [ self.buflen_max-self.buflen[key] for key in keys ] ) # frames that can be added before any buffer gets full
+			for key in keys:
+				self.data_buf[key][self.buflen[key] : self.buflen[key]+n] = frames[key][i:i+n]
+				self.buflen[key] += n
+			i += n
+
 	def decode(self, datastring, datacopy=None):
 		if datastring == b'test':
 			self.decode('copy', datacopy=self.test())
@@ -47,28 +136,12 @@ class SensorPackage():
 			for key in self.data.keys():		self.data[key] = datacopy[key]
 			for key in self.bufinflag.keys():	self.bufinflag[key] = True
 		else:
-			flag, = unpack( 'B', datastring[0:1] )
-			idx = 1
-			if flag & 0x01:
-				self.bufinflag['forc'], self.bufinflag['forc_time'] = True, True
-				self.data['forc_time'], = unpack( 'f', datastring[idx:idx+4] )
-				self.data['forc'][:] = np.reshape( unpack('12f', datastring[idx+4:idx+52]), [4,3] )
-				idx += 52
-			if flag & 0x02:
-				self.bufinflag['disp'], self.bufinflag['disp_time'] = True, True
-				self.data['disp_time'], = unpack( 'f', datastring[idx:idx+4] )
-				self.data['disp'][:] = np.reshape( unpack('12f', datastring[idx+4:idx+52]), [4,3] )
-				idx += 52
-			if flag & 0x04:
-				self.bufinflag['foot'], self.bufinflag['foot_time'] = True, True
-				self.data['foot_time'], = unpack( 'f', datastring[idx:idx+4] )
-				self.data['foot'][:] = np.reshape( unpack('12f', datastring[idx+4:idx+52]), [4,3] )
-				idx += 52
-			if flag & 0x08:
-				self.bufinflag['imu'], self.bufinflag['imu_time'] = True, True
-				self.data['imu_time'], = unpack( 'f', datastring[idx:idx+4] )
-				self.data['imu'][:] = np.reshape( unpack('9f', datastring[idx+4:idx+40]), [3,3] )
-				idx += 40
+			layout = SENSOR_LAYOUTS[datastring[0] & 0x0F]
+			frame = np.frombuffer(datastring, dtype=layout, count=1, offset=1)[0] # a view on /datastring/, no bytes are copied
+			for key in layout.names:
+				if key in self.time_keys:	self.data[key] = float(frame[key])
+				else:						self.data[key][:] = frame[key]
+				self.bufinflag[key] = True
 
 	def encode(self):
 		flag = 0x00
@@ -91,33 +164,62 @@ class SensorPackage():
 		""" add the current frame to the buffer. Attention: must check whether the buffer is full before operation """
 		for key in self.data.keys():
 			if self.bufinflag[key]:
-				self.data_buf[key][self.buflen[key]] = self.data[key]
-				self.buflen[key] += 1
+				if self.ring:
+					h = self.head[key]
+					self.data_buf[key][h] = self.data_buf[key][h+self.buflen_max] = self.data[key]
+					self.head[key] = (h+1) % self.buflen_max
+					self.buflen[key] = min(self.buflen[key]+1, self.buflen_max)
+				else:
+					self.data_buf[key][self.buflen[key]] = self.data[key]
+					self.buflen[key] += 1
+				if self.filters: self.filters[key].update(self.data[key])
 				self.bufinflag[key] = False
 
+	def ringIn(self, key, frames):
+		""" add a batch of /frames/ to the ring buffer of /key/ """
+		frames = frames[-self.buflen_max:] # older frames would be overwritten anyway
+		idx = ( self.head[key] + np.arange(len(frames)) ) % self.buflen_max
+		self.data_buf[key][idx] = self.data_buf[key][idx+self.buflen_max] = frames
+		self.head[key] = (self.head[key]+len(frames)) % self.buflen_max
+		self.buflen[key] = min(self.buflen[key]+len(frames), self.buflen_max)
+
+	@profiled
 	def bufferOut(self):
 		""" write the buffer to file and reset the buffer state (in case the buffer is full) """
+		if self.ring: return
 		for key in self.data.keys():
-			if self.buflen[key] == self.buflen_max: # only the full-buffer terms will be written
-				with open(self.filepath+self.filenames[key], 'a') as fp:
-					for frame in self.data_buf[key]:
-						fp.write( '\t'.join(['%.18e'%n for n in np.ravel(frame)]) + '\n' )
-
+			if self.buflen[key] == self.buflen_max and key not in self.logs: self.buflen[key] = 0 # not logged, simply dumped
+			elif self.buflen[key] == self.buflen_max: # only the full-buffer terms will be written
+				self.writeBuffer(key, self.data_buf[key], recycle=True)
+				self.data_buf[key] = self.spare_buf[key].pop() if self.spare_buf[key] else np.zeros_like(self.data_buf[key]) # swap in a spare buffer, the full one now belongs to the writer
 				self.buflen[key] = 0
 				print(self.filenames[key]+' updated')
+
+	def writeBuffer(self, key, frames, recycle=False):
+		""" hand /frames/ to the log writer. if /recycle/ is True, they are given back to the spare buffers when written """
+		if not self.writer:
+			if not os.path.exists(self.filepath): os.makedirs(self.filepath)
+			self.writer = LogWriter()
+		self.writer.put(self.logs[key], frames, self.spare_buf[key].append if recycle else None)
+
+	def close(self):
+		""" write what is left in the buffers and wait for the log writer to finish. call this when the connection is closed """
+		for key in self.data.keys():
+			if self.buflen[key] and not self.ring and key in self.logs:
+				self.writeBuffer(key, self.data_buf[key][:self.buflen[key]].copy())
+				self.buflen[key] = 0
+		if self.writer: self.writer.close()
 		
 
+	def stats(self):
+		""" the fill of the buffers, and the backlog of the log writer (see LogWriter.stats) """
+		return { 'buffered':max(self.buflen.values()), 'buflen_max':self.buflen_max, 'log':self.writer.stats() if self.writer else {} }
+
 	def checkDataString(self, datastring):
 		if datastring in ('copy', b'test'):
 			return True
 		elif type(datastring) == bytes and len(datastring) >= 1:
-			flag, = unpack( 'B', datastring[0:1] )
-			totlen = 1
-			if flag & 0x01: totlen += 52
-			if flag & 0x02: totlen += 52
-			if flag & 0x03: totlen += 52
-			if flag & 0x04: totlen += 40
-
+			totlen = 1 + SENSOR_LAYOUTS[datastring[0] & 0x0F].itemsize
 			if totlen == len(datastring):
 				return True
 			else:
@@ -135,9 +237,10 @@ class SensorPackage():
 		""" check wether the buffers are empty. if any buffer is empty, filter() and last() cannot be called """
 		return ( 0 in self.buflen.values() )
 
-##### these two methods are for dynamic figure data #####
+##### these methods are for dynamic figure data #####
 	def bufferShift(self):
-		""" shift the buffer one frame backward (in case the buffer is full) """
+		""" shift the buffer one frame backward (in case the buffer is full). ring buffers drop the oldest frame by themselves, nothing to do """
+		if self.ring: return
 		for key in self.data.keys():
 			if self.buflen[key] == self.buflen_max:
 				self.data_buf[key][:] = np.roll(self.data_buf[key], -1, axis=0)
@@ -145,8 +248,14 @@ class SensorPackage():
 
 	def filter(self, filter_size=5):
 		""" generate filtered data by averaging the newest 5 frames. Attention: must check whether the buffer is empty before operation """
-		filter_range = { key:range( max(self.buflen[key]-filter_size, 0), self.buflen[key] ) for key in self.data.keys() }
-		return { key:np.mean( self.data_buf[key][filter_range[key]], axis=0 ) for key in self.data.keys() }
+		""" if incremental filters are set by setFilter, their current outputs are returned instead, and /filter_size/ is not used """
+		if self.filters: return { key:self.filters[key].value for key in self.data.keys() }
+		return { key:np.mean( self.bufferView(key)[-filter_size:], axis=0 ) for key in self.data.keys() }
+
+	def setFilter(self, kind='mean', **para):
+		""" filter every term incrementally as frames are added to the buffer. /kind/ is one of filters.FILTERS """
+		""" 'mean': moving average, para size=5 | 'exp': exponential, para alpha=0.2 | 'biquad': Butterworth low-pass, para cutoff=0.1 (relative to the frame rate) """
+		self.filters = { key:FILTERS[kind](np.shape(self.data[key]), **para) for key in self.data.keys() }
 #########################################################
 
 	def test(self):
@@ -160,11 +269,18 @@ class SensorPackage():
 
 	def last(self):
 		""" return the last frame in data_buf. Attention: must check whether the buffer is empty before operation """
-		return { key:self.data_buf[key][self.buflen[key]-1] for key in self.data.keys() }
+		return { key:self.bufferView(key)[-1] for key in self.data.keys() }
 
 	def bufferGet(self):
 		""" get the valid section of the buffer """
-		return { key:self.data_buf[key][:self.buflen[key]] for key in self.data.keys() }
+		return { key:self.bufferView(key) for key in self.data.keys() }
+
+	def bufferView(self, key):
+		""" the valid frames of /key/ in order, oldest first. this is a view on data_buf, no data are copied """
+		if self.ring:
+			end = self.head[key] + self.buflen_max
+			return self.data_buf[key][end-self.buflen[key] : end]
+		return self.data_buf[key][:self.buflen[key]]
 
 
 class StatePackage():
@@ -269,12 +385,40 @@ class Protocol():
 		self.para = ParameterPackage()
 
 		self.cnt = 0 # how many data packages have been processed
+		self.tracer = None # stamps the batches of distrib_many, see tracing.Tracer. None: not traced
+
+		# frames and bytes (protocol header included) received and sent, per package type, see stats()
+		self.frames_in, self.bytes_in = collections.Counter(), collections.Counter()
+		self.frames_out, self.bytes_out = collections.Counter(), collections.Counter()
 
 	def distrib(self, datastring):
 		""" process the received data: do a first-layer-decode and distribute the data to the class specified by /typ/ """
 		if type(datastring) == bytes and len(datastring) >= 3:
 			self.decode(datastring)
 			self.cnt += 1
+			self.frames_in[self.typ] += 1
+			self.bytes_in[self.typ] += len(datastring)
+
+	@profiled
+	def distrib_many(self, datastrings):
+		""" the batch version of /distrib/. sensor packages are collected and processed together by SensorPackage.process_many """
+		sens_data = []
+		for datastring in datastrings:
+			if type(datastring) == bytes and len(datastring) >= 3:
+				self.ver, self.ack, self.typ = datastring[0], datastring[1], datastring[2]
+				self.data = datastring[3:]
+				if self.typ == 0x01:	sens_data.append(self.data)
+				else:
+					self.decode(datastring)
+					self.frames_in[self.typ] += 1
+					self.bytes_in[self.typ] += len(datastring)
+				self.cnt += 1
+		if sens_data: # counted in bulk, this is the hot path
+			self.frames_in[0x01] += len(sens_data)
+			self.bytes_in[0x01] += sum(map(len, sens_data)) + 3 * len(sens_data)
+		if self.tracer: self.tracer.stamp('decoded')
+		self.sens.process_many(sens_data)
+		if self.tracer: self.tracer.stamp('buffered', cnt=self.cnt)
 
 	def collect(self, typ, ack):
 		""" collect the data before send """
@@ -289,6 +433,7 @@ class Protocol():
 		if self.ack: return self.collect(typ=self.ack, ack=0x00)
 		else: return None
 
+	@profiled
 	def decode(self, datastring):
 		""" first-layer-decode, extract the frame header """
 		self.ver, = unpack( 'B', datastring[0:1] )
@@ -307,7 +452,17 @@ class Protocol():
 		elif self.typ == 0x03:	self.data = self.comd.encode()
 		elif self.typ == 0x04:	self.data = self.para.encode()
 
-		return pack( '3B', self.ver, self.ack, self.typ ) + self.data
+		datastring = pack( '3B', self.ver, self.ack, self.typ ) + self.data
+		self.frames_out[self.typ] += 1
+		self.bytes_out[self.typ] += len(datastring)
+		return datastring
+
+	def stats(self):
+		""" frames and bytes received and sent, per package type (see PACKAGE_TYPES) """
+		name = lambda typ: PACKAGE_TYPES.get(typ, '0x%02X'%typ)
+		return { 'frames':self.cnt,
+				 'in' :{ name(typ):{ 'frames':self.frames_in[typ],  'bytes':self.bytes_in[typ]  } for typ in sorted(self.frames_in)  },
+				 'out':{ name(typ):{ 'frames':self.frames_out[typ], 'bytes':self.bytes_out[typ] } for typ in sorted(self.frames_out) } }
 
 
 
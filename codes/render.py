@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import time
+
+from profiling import profiled
+
+
+class RenderTarget():
+	""" a figure (or a group of figures) refreshed by /func/. /visible/ tells wether it can be seen now, /key/ what it shows now (e.g. the current tab) """
+	""" it is refreshed on every /every/ tick at most, and only when the data have changed since it last showed /key/ """
+
+	def __init__(self, name, func, visible, key, every, phase):
+		self.name = name
+		self.func = func
+		self.visible = visible
+		self.key = key
+		self.every = every
+		self.phase = phase
+		self.drawn = {}		# the data version drawn, for every key shown
+		self.cost = 0.0		# time of one refresh, exponential average
+		self.cnt = 0		# how many times it has been refreshed
+		self.hidden = 0		# how many refreshes were due while it could not be seen
+
+
+class RenderScheduler():
+	""" refresh the figures at a steady rate whatever the frame rate: new data only mark the figures dirty (mark()), and a timer calls tick() every /interval/ seconds """
+	""" a tick refreshes the targets that are visible and dirty, so a hidden tab or a minimised window costs nothing, and nothing is redrawn while no data arrive """
+	""" the interval starts at 1 / /fps/ seconds, and grows when the refreshes take more than /budget/ of the time (0.5: half of the GUI thread), down to /fps_min/ """
+	""" pure Python, the GUI owns the timer: see MainWindow """
+
+	def __init__(self, fps=25, fps_min=5, budget=0.5, smoothing=0.2):
+		self.fps = fps
+		self.fps_min = fps_min
+		self.budget = budget
+		self.smoothing = smoothing # weight of the newest tick in the averaged cost
+		self.interval = 1 / fps
+		self.targets = {}
+		self.version = 0	# raised by every mark()
+		self.ticks = 0
+		self.cost = 0.0		# the expected refresh time of one tick: the cost of every target divided by its /every/
+		self.time_last = None
+		self.period = 0.0	# time between two ticks that refreshed something, exponential average
+
+	def add(self, name, func, visible=lambda: True, key=lambda: None, every=1):
+		""" add a target refreshed by func(), see RenderTarget. targets with the same /every/ get different phases, so that their refreshes are staggered """
+		phase = sum( target.every == every for target in self.targets.values() ) % every
+		self.targets[name] = RenderTarget(name, func, visible, key, every, phase)
+
+	def mark(self):
+		""" new data have arrived, every target is dirty """
+		self.version += 1
+
+	def dirty(self, target):
+		return target.drawn.get(target.key()) != self.version
+
+	def refresh(self, target):
+		time0 = time.perf_counter()
+		target.func()
+		cost = time.perf_counter() - time0
+		target.drawn[target.key()] = self.version
+		target.cost = cost if not target.cnt else target.cost + self.smoothing * (cost - target.cost)
+		target.cnt += 1
+		return cost
+
+	def show(self, name):
+		""" refresh target /name/ now if it is visible and dirty, e.g. when its tab has just been chosen """
+		target = self.targets[name]
+		if target.visible() and self.dirty(target): self.refresh(target)
+
+	@profiled
+	def tick(self):
+		""" refresh the targets due. return wether any has been refreshed. the interval of the next tick is then in /interval/ """
+		self.ticks += 1
+		drawn = False
+		for target in self.targets.values():
+			if (self.ticks + target.phase) % target.every or not self.dirty(target): continue
+			if not target.visible():
+				target.hidden += 1
+				continue
+			self.refresh(target)
+			drawn = True
+		if drawn:
+			now = time.perf_counter()
+			if self.time_last is not None: self.period = now - self.time_last if not self.period else self.period + self.smoothing * (now - self.time_last - self.period)
+			self.time_last = now
+			self.cost = sum( target.cost / target.every for target in self.targets.values() ) # not the cost of this tick, which depends on the targets due
+			self.interval = min( max(1 / self.fps, self.cost / self.budget), 1 / self.fps_min )
+		return drawn
+
+	def stats(self):
+		""" the interval, the rate of the ticks that refreshed something, and the refresh time of every target """
+		return { 'interval':self.interval, 'fps':1 / self.period if self.period else 0.0, 'cost':self.cost,
+				 'targets':{ name:{ 'refreshes':target.cnt, 'cost':target.cost, 'hidden':target.hidden } for name, target in self.targets.items() } }
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import os
+import sys
+import time
+import queue
+import threading
+from struct import Struct
+
+from profiling import PROFILER
+
+
+""" binary sensor log format (version 1):
+	header, padded to LOG_HEADER_SIZE bytes:
+		magic (4s) | version (H) | header size (H) | channel name (16s) | dtype string (8s) | ndim (B) | shape (4I)
+	followed by raw fixed-size records, one per frame, each of /shape/ and /dtype/, in C order
+	all header fields are little-endian. the records can be mapped directly with np.memmap """
+
+LOG_MAGIC = b'UPCL'
+LOG_VERSION = 1
+LOG_HEADER = Struct('<4sHH16s8sB4I')
+LOG_HEADER_SIZE = 64
+
+
+class SensorLog():
+	""" an append-only log file for one channel of SensorPackage """
+	""" /logformat/ is 'bin' for the binary format described above, or 'txt' for the old '%.18e' text format, one frame per line """
+
+	def __init__(self, filename, key, shape, dtype='<f4', logformat='bin'):
+		self.filename = filename
+		self.key = key
+		self.shape = tuple(shape)
+		self.dtype = np.dtype(dtype)
+		self.logformat = logformat
+
+	def append(self, frames):
+		""" append /frames/ (an array of shape [n, *shape]) to the file. the header is written when the file is created """
+		if self.logformat == 'txt':
+			with open(self.filename, 'a') as fp:
+				for frame in frames:
+					fp.write( '\t'.join(['%.18e'%n for n in np.ravel(frame)]) + '\n' )
+		else:
+			frames = np.ascontiguousarray(frames, dtype=self.dtype)
+			with open(self.filename, 'ab') as fp:
+				if fp.tell() == 0: fp.write(self.header())
+				frames.tofile(fp)
+
+	def header(self):
+		shape = list(self.shape) + [0] * (4-len(self.shape))
+		header = LOG_HEADER.pack( LOG_MAGIC, LOG_VERSION, LOG_HEADER_SIZE, self.key.encode(), self.dtype.str.encode(), len(self.shape), *shape )
+		return header + b'\x00' * (LOG_HEADER_SIZE-len(header))
+
+
+class LogWriter():
+	""" append frames to log files in a separate thread, so that the receive path does not wait for the disk """
+	""" at most /maxsize/ blocks wait in the queue. when it is full, /put/ blocks until the writer catches up, so no frame is lost """
+
+	def __init__(self, maxsize=16):
+		self.queue = queue.Queue(maxsize)
+
+		# statistics, see stats()
+		self.cnt = 0				# how many blocks have been written
+		self.frames = 0				# how many frames have been written
+		self.depth_max = 0			# the maximum queue depth ever seen
+		self.latency = 0.0			# time from put() to the end of writing, of the last block
+		self.latency_max = 0.0
+		self.latency_sum = 0.0
+
+		self.thrd = threading.Thread(target=self.__loop, name='LogWriter', daemon=True) # daemon means the thread terminates as the main thread exits
+		self.thrd.start()
+
+	def put(self, log, frames, callback=None):
+		""" queue /frames/ to be appended to /log/ (a SensorLog). the writer owns /frames/ until /callback/(frames) is called after writing """
+		self.queue.put( (log, frames, callback, time.perf_counter()) )
+		self.depth_max = max(self.depth_max, self.queue.qsize())
+
+	def flush(self):
+		""" wait until every queued block is written """
+		self.queue.join()
+
+	def close(self):
+		""" flush and stop the thread """
+		if self.thrd.is_alive():
+			self.queue.put(None)
+			self.thrd.join()
+
+	def stats(self):
+		return {
+			'depth':		self.queue.qsize(),
+			'depth_max':	self.depth_max,
+			'blocks':		self.cnt,
+			'frames':		self.frames,
+			'latency':		self.latency,
+			'latency_max':	self.latency_max,
+			'latency_mean':	self.latency_sum / self.cnt if self.cnt else 0.0	}
+
+	def __loop(self):
+		while True:
+			job = self.queue.get()
+			if job is None:
+				self.queue.task_done()
+				break
+
+			log, frames, callback, time0 = job
+			try:
+				with PROFILER.span('SensorLog.append'): log.append(frames)
+			except Exception as ex: print('\nLog writing failed:', log.filename, ex)
+			else:
+				self.latency = time.perf_counter() - time0
+				self.latency_max = max(self.latency_max, self.latency)
+				self.latency_sum += self.latency
+				self.cnt += 1
+				self.frames += len(frames)
+			finally:
+				if callback: callback(frames)
+				self.queue.task_done()
+
+
+def readHeader(filename):
+	""" return the channel name, the shape and dtype of one record and the offset of the first record """
+	with open(filename, 'rb') as fp:
+		magic, version, size, key, dtype, ndim, *shape = LOG_HEADER.unpack( fp.read(LOG_HEADER.size) )
+	if magic != LOG_MAGIC:		raise ValueError('%s is not a binary sensor log'%filename)
+	if version > LOG_VERSION:	raise ValueError('%s has an unsupported log version %i'%(filename, version))
+	return key.rstrip(b'\x00').decode(), tuple(shape[:ndim]), np.dtype(dtype.rstrip(b'\x00').decode()), size
+
+
+def read(filename, shape=None):
+	""" read a sensor log as an array of shape [frames, *shape] """
+	""" binary logs are mapped with np.memmap without reading the file. text logs carry no shape, so /shape/ of one record may be given to reshape them """
+	if filename.endswith('.txt'):
+		data = np.loadtxt(filename, ndmin=2)
+		return data if shape is None else np.reshape(data, [len(data), *shape])
+
+	key, shape, dtype, offset = readHeader(filename)
+	nframes = ( os.path.getsize(filename)-offset ) // ( dtype.itemsize * int(np.prod(shape)) ) # an incomplete last record (e.g. after a crash) is ignored
+	if nframes == 0: return np.zeros([0, *shape], dtype=dtype)
+	return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(nframes, *shape))
+
+
+if __name__ == '__main__':
+	""" print a summary of the log files given in the command line """
+	for filename in sys.argv[1:]:
+		data = read(filename)
+		print(filename, data.dtype, data.shape)
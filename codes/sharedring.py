@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+from protocol import SENSOR_CHANNELS
+
+
+""" shared sensor ring (version 2), a block of shared memory written by one process and read by others, e.g. the GUI or analysis scripts:
+	header (RING_HEADER), padded to RING_HEADER_SIZE bytes
+	frame counters, one uint64 per key in RING_KEYS: how many frames of the key have ever been written
+	ring buffers, one per key in RING_KEYS: float64 arrays of shape [2*buflen, *shape], as SensorPackage.data_buf in ring mode
+	every frame is stored twice, at /head/ and /head+buflen/ (head = counter % buflen), so that the newest frames in order are always a contiguous slice
+	the writer stores the frames before it raises the counter, so the frames below a counter read are complete. they may be overwritten by the writer
+	while they are read, if the reader falls /buflen/ frames behind
+	the sequence number /seq/ of the header is a seqlock: it is odd while the writer is writing, and raised again when it is done.
+	a reader that sees the same even /seq/ before and after reading has read a consistent state, see read() """
+
+RING_MAGIC = b'UPCR'
+RING_VERSION = 2
+RING_HEADER = np.dtype([ ('magic', 'S4'), ('version', '<u2'), ('nkeys', '<u2'), ('buflen', '<u4'), ('connected', '<u4'), ('alive', '<f8'), ('frames', '<u8'), ('seq', '<u8') ])
+RING_HEADER_SIZE = 64
+RING_KEYS = [ (key, shape) for bit, key, shape in SENSOR_CHANNELS ] + [ (key+'_time', ()) for bit, key, shape in SENSOR_CHANNELS ] # the order of SensorPackage.data
+
+
+def openSharedMemory(name, size=0, create=False):
+	""" open a shared memory block that outlives the processes using it: it is only removed by unlink(), so that either side may restart """
+	if sys.version_info >= (3, 13): return shared_memory.SharedMemory(name, create, size, track=False)
+	shm = shared_memory.SharedMemory(name, create, size)
+	if os.name == 'posix': # before Python 3.13, the resource tracker removes the block when any process using it exits
+		from multiprocessing import resource_tracker
+		resource_tracker.unregister(shm._name, 'shared_memory')
+	return shm
+
+
+class SharedSensorRing():
+	""" the newest /buflen/ frames of every sensor channel in shared memory, see the layout above """
+	""" the writer opens it with /create/ True: a block left by a previous writer with the same layout is reused, and its counters go on """
+	""" a reader opens it with /create/ False, which raises FileNotFoundError if no writer has created it yet. e.g. in Jupyter, while the GUI runs with --tap: """
+	"""		ring = SharedSensorRing('uppercomputer_sensors'); ring.latest()['imu']; ring.history(100)['forc_time'] """
+
+	def __init__(self, name='uppercomputer_sensors', buflen=500, create=False):
+		self.name = name
+		size = RING_HEADER_SIZE + 8 * len(RING_KEYS) + sum( 8 * 2 * buflen * int(np.prod(shape)) for key, shape in RING_KEYS )
+		try:
+			self.shm = openSharedMemory(name, size, create)
+			fresh = create
+		except FileExistsError:
+			self.shm = openSharedMemory(name)
+			fresh = False
+
+		self.header = np.ndarray((), dtype=RING_HEADER, buffer=self.shm.buf)
+		if fresh:
+			self.header['magic'], self.header['version'], self.header['nkeys'], self.header['buflen'] = RING_MAGIC, RING_VERSION, len(RING_KEYS), buflen
+		elif self.header['magic'] != RING_MAGIC or self.header['version'] != RING_VERSION or self.header['nkeys'] != len(RING_KEYS):
+			self.close()
+			raise ValueError('%s is not a shared sensor ring of version %i'%(name, RING_VERSION))
+		elif create and self.header['buflen'] != buflen:
+			self.close()
+			raise ValueError('%s exists with buflen %i'%(name, self.header['buflen']))
+		self.buflen = int(self.header['buflen'])
+		if create and not fresh and self.header['seq'] % 2: self.header['seq'] += 1 # a previous writer was killed while writing, the readers would wait for it forever
+
+		offset = RING_HEADER_SIZE
+		self.counts = np.ndarray([len(RING_KEYS)], dtype='<u8', buffer=self.shm.buf, offset=offset)
+		offset += self.counts.nbytes
+		self.index = { key:i for i, (key, shape) in enumerate(RING_KEYS) }
+		self.data_buf = {}
+		for key, shape in RING_KEYS:
+			self.data_buf[key] = np.ndarray([2*self.buflen, *shape], dtype='<f8', buffer=self.shm.buf, offset=offset)
+			offset += self.data_buf[key].nbytes
+
+##### written by the acquisition process #####
+	def publish(self, frames):
+		""" add the decoded sensor /frames/ (a structured array of protocol.SENSOR_FRAMES) to the ring. called by SensorPackage """
+		self.header['seq'] += 1 # odd: writing
+		for key in frames.dtype.names:
+			if key in self.data_buf: self.ringIn(key, frames[key])
+		self.header['frames'] += len(frames)
+		self.header['seq'] += 1 # even: done
+
+	def ringIn(self, key, frames):
+		""" add a batch of /frames/ to the ring of /key/, see SensorPackage.ringIn """
+		frames = frames[-self.buflen:] # older frames would be overwritten anyway
+		count = int(self.counts[self.index[key]])
+		idx = ( count + np.arange(len(frames)) ) % self.buflen
+		self.data_buf[key][idx] = self.data_buf[key][idx+self.buflen] = frames
+		self.counts[self.index[key]] = count + len(frames) # raised after the frames are stored
+
+	def beat(self, connected):
+		""" tell the readers that the writer is alive, and wether it is connected to the robot """
+		self.header['connected'] = connected
+		self.header['alive'] = time.time()
+##############################################
+
+##### read by the other processes #####
+	def count(self, key):
+		return int(self.counts[self.index[key]])
+
+	def bufferView(self, key, count=None):
+		""" the newest frames of /key/ in order, oldest first, up to the frame counter /count/ (the current one by default). a view on the shared memory, no data are copied """
+		if count is None: count = self.count(key)
+		n = min(count, self.buflen)
+		end = count % self.buflen + self.buflen
+		return self.data_buf[key][end-n : end]
+
+	def read(self, func, retries=1000):
+		""" return func(self), called again until the writer has not written meanwhile (seqlock), so that its result is consistent """
+		""" /func/ may compute directly on the views of bufferView(), which are only consistent during the call: a view kept has to be copied """
+		for i in range(retries):
+			seq = int(self.header['seq'])
+			if seq % 2:
+				time.sleep(0) # the writer is writing, let it go on
+				continue
+			result = func(self)
+			if int(self.header['seq']) == seq: return result
+		raise TimeoutError('%s is written too often to be read'%self.name)
+
+	def latest(self):
+		""" a consistent copy of the newest frame of every key. a key never written is missing """
+		return self.read( lambda ring: { key:np.array(ring.bufferView(key)[-1]) for key, shape in RING_KEYS if ring.count(key) } )
+
+	def history(self, n=None):
+		""" a consistent copy of the newest /n/ frames (all the frames in the ring by default) of every key, oldest first """
+		n = self.buflen if n is None else min(n, self.buflen)
+		return self.read( lambda ring: { key:np.array(ring.bufferView(key)[-n:]) if n else ring.bufferView(key)[:0].copy() for key, shape in RING_KEYS } )
+
+	def is_connected(self, timeout=1.0):
+		""" wether the writer has told within /timeout/ seconds that it is connected to the robot """
+		return bool(self.header['connected']) and time.time() - float(self.header['alive']) < timeout
+#######################################
+
+	def close(self):
+		""" unmap the block. it stays in the system for the other side """
+		self.header = self.counts = self.data_buf = None # the views must be released before the memory is unmapped
+		self.shm.close()
+
+	def unlink(self):
+		""" remove the block from the system, when no side needs it any more """
+		if sys.version_info < (3, 13) and os.name == 'posix': # unlink() tells the resource tracker, which must know the block, see openSharedMemory
+			from multiprocessing import resource_tracker
+			resource_tracker.register(self.shm._name, 'shared_memory')
+		self.shm.unlink()
+
+
+if __name__ == '__main__':
+	""" print the newest frame of a ring every second: python sharedring.py [name] """
+	ring = SharedSensorRing(*sys.argv[1:2])
+	while True:
+		print( 'connected' if ring.is_connected() else 'disconnected', 'frames', int(ring.header['frames']) )
+		for key, value in ring.latest().items(): print( '  %-10s'%key, np.array2string(np.ravel(value), precision=3, max_line_width=200) )
+		time.sleep(1)
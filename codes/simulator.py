@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+""" a simulated robot, for testing the upper computer (the GUI, Client, daemon.py) without hardware. run from the /codes/ directory: """
+"""		python simulator.py --rate 2000 --flags 0x0F 0x03 """
+"""		python simulator.py --replay ../log/log_261017213629 """
+""" it serves on the port of the robot, streams sensor frames at /rate/ frames per second, answers state, command and parameter requests """
+""" as the robot does (see Protocol.process), and exchanges heartbeats (see Server) """
+import sys
+import time
+import glob
+import argparse
+import threading
+import numpy as np
+from struct import pack
+
+from protocol import Protocol, SENSOR_CHANNELS, SENSOR_FRAMES
+from communication import Server, CHECKSUMS
+import sensorlog
+
+
+class Waveform():
+	""" synthetic sensor data of a trotting robot, /gait/ cycles per second """
+	""" diagonal legs (LF and RB, RF and LB) move together. the joints of a leg follow the gait with phase lags, the feet only push during stance """
+
+	def __init__(self, gait=1.0, noise=0.01, seed=None):
+		self.gait = gait
+		self.noise = noise
+		self.random = np.random.default_rng(seed)
+		self.leg_phase = np.array([0.0, 0.5, 0.5, 0.0])[:, None] # LF, RF, LB, RB
+		self.joint_phase = np.array([0.0, 0.1, 0.2])[None, :]
+
+	def frames(self, t):
+		""" the data of every channel at the times /t/ (an array, in seconds). returns { key:array [len(t), *shape] } """
+		phase = 2 * np.pi * ( self.gait * t[:, None, None] - self.leg_phase - self.joint_phase )
+		stance = np.maximum( np.sin(phase[:, :, :1]), 0 ) # [n, 4, 1]
+		data = {
+			'forc': 8000.0 + 3000.0 * np.sin(phase),
+			'disp': 50.0 + 20.0 * np.sin(phase + np.pi/2),
+			'foot': np.concatenate([ 40.0 * np.cos(phase[:, :, :1]) * stance, 20.0 * np.sin(phase[:, :, :1]) * stance, 800.0 * stance ], axis=2),
+			'imu' : np.stack([
+				np.stack([ 2.0 * np.sin(2*np.pi*0.05*t), 1.5 * np.sin(4*np.pi*self.gait*t), 1.0 * np.sin(4*np.pi*self.gait*t + 1.0) ], axis=1),	# attitude angle
+				np.stack([ 0.6 * np.cos(2*np.pi*0.05*t), 18.8 * self.gait * np.cos(4*np.pi*self.gait*t), 12.6 * self.gait * np.cos(4*np.pi*self.gait*t + 1.0) ], axis=1), # angular velocity
+				np.stack([ 0.5 * np.sin(4*np.pi*self.gait*t), 0.3 * np.sin(2*np.pi*self.gait*t), 9.8 + 1.5 * np.sin(4*np.pi*self.gait*t) ], axis=1) ], axis=1)	}	# acceleration
+		for key in data.keys(): data[key] = data[key] * ( 1 + self.noise * self.random.standard_normal(data[key].shape) )
+		return data
+
+
+class Replay():
+	""" sensor data replayed from the logs written by SensorPackage, in a loop. /prefix/ is the log file name without '_key.bin', e.g. ../log/log_261017213629 """
+	""" every channel is replayed frame by frame, whatever its recorded time stamps. a channel without log is filled with zeros """
+
+	def __init__(self, prefix):
+		self.logs = {}
+		for bit, key, shape in SENSOR_CHANNELS:
+			filenames = glob.glob('%s_%s.bin'%(prefix, key)) + glob.glob('%s_%s.txt'%(prefix, key))
+			if filenames:
+				data = sensorlog.read(filenames[0], shape)
+				if len(data): self.logs[key] = data
+		if not self.logs: raise FileNotFoundError('no sensor log named %s_*'%prefix)
+		self.cnt = 0
+
+	def frames(self, t):
+		data = {}
+		for bit, key, shape in SENSOR_CHANNELS:
+			if key in self.logs: data[key] = self.logs[key][ (self.cnt + np.arange(len(t))) % len(self.logs[key]) ]
+			else:                data[key] = np.zeros([len(t), *shape])
+		self.cnt += len(t)
+		return data
+
+
+class RobotSimulator():
+	""" the simulated robot: a Server that sends sensor frames from /source/ (a Waveform or a Replay) at /rate/ frames per second """
+	""" the flag byte of the frames cycles through /flags/, e.g. (0x0F,) for every channel in every frame, or (0x0B, 0x04) for the foot force every other frame """
+	""" the frames due are sent every /tick/ seconds, so rates of several kHz need no sleep shorter than /tick/ """
+
+	def __init__(self, rate=1000, flags=(0x0F,), source=None, port=8006, checksum='sum', tick=0.002):
+		self.rate = rate
+		self.flags = flags
+		self.source = source if source else Waveform()
+		self.tick = tick
+		self.prot = Protocol() # answers the requests, as the robot does
+		self.header = pack('3B', self.prot.ver, 0x00, 0x01) # ver, ack, typ of a sensor frame
+		self.server = Server(checksum=checksum, port=port, callback=self.answer)
+
+		self.cnt = 0 # how many sensor frames are due since the start. the frames due while no client is connected are skipped
+		self.sent = 0 # how many sensor frames have been sent
+		self.answered = 0 # how many requests have been answered
+		self.flag = True
+		self.thrd = threading.Thread(target=self.__loop, name='RobotSimulator', daemon=True)
+		self.thrd.start()
+
+	def answer(self, datastring):
+		""" called by the server for every frame received: decode it and return the answer asked by its ack byte, like the robot """
+		ans = self.prot.process(datastring)
+		if ans: self.answered += 1
+		return ans
+
+	def close(self):
+		if self.flag:
+			self.flag = False
+			self.thrd.join()
+			self.server.close()
+
+	def datastrings(self, t):
+		""" the sensor frames at times /t/, with their protocol header: ver, ack, typ (0x01) | flag | channels of the flag, see protocol.SENSOR_FRAMES """
+		data = self.source.frames(t)
+		flags = [ self.flags[(self.cnt+i) % len(self.flags)] for i in range(len(t)) ]
+		frames = [None] * len(t)
+		for flag in set(flags):
+			idx = [ i for i in range(len(t)) if flags[i] == flag ]
+			records = np.zeros(len(idx), dtype=SENSOR_FRAMES[flag])
+			records['flag'] = flag
+			for bit, key, shape in SENSOR_CHANNELS:
+				if flag & bit:
+					records[key+'_time'] = t[idx]
+					records[key] = data[key][idx]
+			raw, size = records.tobytes(), records.dtype.itemsize
+			for j, i in enumerate(idx): frames[i] = self.header + raw[j*size : (j+1)*size]
+		return frames
+
+	def __loop(self):
+		time0 = time.monotonic()
+		while self.flag:
+			due = int( (time.monotonic()-time0) * self.rate ) - self.cnt
+			if due > self.rate: # more than 1 second behind (e.g. the machine was suspended), skip instead of bursting
+				self.cnt += due - 1
+				due = 1
+			if due > 0 and self.server.get_connection_state():
+				for datastring in self.datastrings( (self.cnt + np.arange(due)) / self.rate ): self.server.send(datastring)
+				self.sent += due
+			self.cnt += max(due, 0)
+			time.sleep(self.tick)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='a simulated robot, for testing the upper computer without hardware')
+	parser.add_argument('-r', '--rate', type=float, default=1000, help='sensor frames per second (default 1000)')
+	parser.add_argument('-f', '--flags', nargs='+', type=lambda s: int(s, 0), default=[0x0F], help='flag bytes of the frames, used in turn (default 0x0F: every channel)')
+	parser.add_argument('--replay', default=None, metavar='PREFIX', help='replay the sensor logs PREFIX_forc.bin, ... instead of the synthetic waveform')
+	parser.add_argument('--gait', type=float, default=1.0, help='gait cycles per second of the synthetic waveform (default 1)')
+	parser.add_argument('-p', '--port', type=int, default=8006)
+	parser.add_argument('--checksum', choices=list(CHECKSUMS.keys()), default='sum')
+	parser.add_argument('-d', '--duration', type=float, default=0, help='seconds to run, 0 for no limit (default)')
+	args = parser.parse_args(argv)
+
+	source = Replay(args.replay) if args.replay else Waveform(args.gait)
+	sim = RobotSimulator(args.rate, args.flags, source, args.port, args.checksum)
+	time_end = time.time() + args.duration if args.duration else None
+	try:
+		while not time_end or time.time() < time_end:
+			sent, time0 = sim.sent, time.time()
+			time.sleep(1)
+			print( 'clients %i  sent %i  (%.0f /s)  answered %i' % (len(sim.server.I_sockets), sim.sent, (sim.sent-sent) / (time.time()-time0), sim.answered) )
+	except KeyboardInterrupt: pass
+	sim.close()
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import threading
+import collections
+import numpy as np
+
+
+""" opt-in latency tracing of the sensor frames, from the socket to the figures. every frame is stamped with time.monotonic() at these stages: """
+"""		read		its last bytes are read from the socket (Client.read) """
+"""		framed		it is cut out of the stream (Client.decode) """
+"""		decoded		its protocol header is decoded (Protocol.distrib_many) """
+"""		buffered	it is decoded into SensorPackage and put into the buffer (Protocol.distrib_many) """
+"""		figdata		the snapshot holding it is added to the figure data (MainWindow.update_figdata) """
+"""		painted		the figures are refreshed with it (MainWindow.hear) """
+""" the frames travel in batches (one socket read, one recv_all), so the stages from 'decoded' on are stamped once per batch """
+""" the latency of every stage from the previous one feeds a Histogram, as well as 'total' (from 'read' to the last stage) and 'robot' (see Tracer.publish) """
+""" nothing is traced unless a Tracer is given to Acquisition (python main.py --trace, python daemon.py --trace): the hooks only test wether it is set """
+
+STAGES = ('read', 'framed', 'decoded', 'buffered', 'figdata', 'painted')
+
+
+class Histogram():
+	""" a histogram of latencies in the manner of HdrHistogram: the buckets are linear within every power of two, so that any value between /lowest/ and """
+	""" /highest/ seconds is kept with a relative error below 2**-/bits/ (0.8 % by default), in a fixed array of counts. recording never allocates """
+
+	def __init__(self, lowest=1e-6, highest=100.0, bits=7):
+		self.lowest = lowest
+		self.bits = bits
+		self.counts = np.zeros(int(self.index(highest)) + 1, dtype=np.int64)
+		self.reset()
+
+	def reset(self):
+		self.counts[:] = 0
+		self.total = 0
+		self.sum = 0.0
+		self.min = float('inf')
+		self.max = 0.0
+
+	def index(self, values):
+		""" the bucket of /values/ (seconds): the integer count v of /lowest/ is shifted right by e, so that v>>e keeps bits+1 bits """
+		v = np.maximum( np.asarray(values) / self.lowest, 0 ).astype(np.int64)
+		e = np.maximum( np.frexp(v)[1] - self.bits - 1, 0 )
+		return (e << self.bits) + (v >> e)
+
+	def value(self, idx):
+		""" the middle of bucket /idx/, in seconds """
+		e = np.maximum( (np.asarray(idx) >> self.bits) - 1, 0 )
+		v = (idx - (e << self.bits)) << e
+		return (v + ((1 << e) - 1) / 2) * self.lowest
+
+	def record(self, values, count=1):
+		""" add /values/ (seconds, a number or an array), each /count/ times """
+		values = np.atleast_1d(values)
+		if not len(values) or not count: return
+		np.add.at( self.counts, np.minimum(self.index(values), len(self.counts)-1), count )
+		self.total += len(values) * count
+		self.sum += float(np.sum(values)) * count
+		self.min = min(self.min, float(np.min(values)))
+		self.max = max(self.max, float(np.max(values)))
+
+	def percentile(self, q):
+		""" the latency below which /q/ percent of the values are """
+		if not self.total: return 0.0
+		idx = int(np.searchsorted( np.cumsum(self.counts), q / 100 * self.total ))
+		return min( max(float(self.value(idx)), self.min), self.max )
+
+	def summary(self):
+		""" count, mean, min, max and the usual percentiles, in seconds """
+		summary = { 'count':self.total, 'mean':self.sum / self.total if self.total else 0.0, 'min':self.min if self.total else 0.0, 'max':self.max }
+		for q in (50, 90, 99, 99.9): summary['p%g'%q] = self.percentile(q)
+		return summary
+
+	def buckets(self):
+		""" the non-empty buckets, { middle value:count }, e.g. to merge or plot histograms of several runs """
+		idx = np.nonzero(self.counts)[0]
+		return { '%.9g'%value:int(count) for value, count in zip(self.value(idx), self.counts[idx]) }
+
+
+class Tracer():
+	""" the stage time stamps of the frames in flight, and a Histogram per stage. /stages/ are the stages traced, in order, a prefix of STAGES: """
+	""" a process without GUI (daemon.py) traces up to 'buffered', the frames are then complete """
+	""" the frames are followed by their sequence number in the receive queue of the client (see FrameQueue.entered and FrameQueue.taken) """
+	""" and by the frame count of Protocol, which the snapshots of Acquisition carry to the GUI. the hooks are called from the acquisition thread and the GUI """
+
+	def __init__(self, stages=STAGES, maxlen=10000):
+		self.stages = stages
+		self.histograms = { stage:Histogram() for stage in stages[1:] + ('total', 'robot') }
+		self.reads = collections.deque(maxlen=maxlen)	# (sequence number, frames, read time, framed time) of every socket read with frames
+		self.batches = collections.deque(maxlen=maxlen)	# the batches taken from the receive queue and not yet complete: { stage:time stamps, 'cnt':frame count }
+		self.robot_offset = float('inf')				# the smallest delay seen between the robot clock and time.monotonic(), see publish()
+		self.lock = threading.Lock()
+
+	def framed(self, seq, n, read_time):
+		""" /n/ frames, which enter the receive queue with the sequence numbers from /seq/, are cut out of bytes read at /read_time/ """
+		if n:
+			with self.lock: self.reads.append( (seq, n, read_time, time.monotonic()) )
+
+	def take(self, seq, n):
+		""" /n/ frames, from the sequence number /seq/ on, are taken out of the receive queue. they are followed as one batch from here on """
+		""" frames dropped by the queue are skipped over, frames read before the tracer was set have no stamps and are not recorded """
+		if not n: return
+		read, framed = np.full(n, np.nan), np.full(n, np.nan)
+		with self.lock:
+			while self.reads and self.reads[0][0] + self.reads[0][1] <= seq: self.reads.popleft()
+			for s, m, read_time, framed_time in self.reads:
+				if s >= seq + n: break
+				i, j = max(s, seq) - seq, min(s+m, seq+n) - seq
+				read[i:j], framed[i:j] = read_time, framed_time
+			self.batches.append( { 'read':read, 'framed':framed, 'cnt':None } )
+
+	def stamp(self, stage, cnt=None, upto=None):
+		""" stamp /stage/ now on every batch that has passed the previous stage, and record the batches complete """
+		""" /cnt/ is the frame count of Protocol after the batch, given with 'buffered'. with /upto/, only the batches up to this frame count are stamped """
+		if stage not in self.stages: return
+		now = time.monotonic()
+		prev = self.stages[self.stages.index(stage)-1]
+		with self.lock:
+			for batch in self.batches:
+				if stage in batch or prev not in batch: continue
+				if upto is not None and batch['cnt'] > upto: break
+				batch[stage] = now
+				if cnt is not None: batch['cnt'] = cnt
+			while self.batches and self.stages[-1] in self.batches[0]: self.record(self.batches.popleft())
+
+	def record(self, batch):
+		valid = ~np.isnan(batch['read'])
+		for prev, stage in zip(self.stages[:-1], self.stages[1:]):
+			latency = np.asarray(batch[stage] - batch[prev])
+			if latency.ndim:	self.histograms[stage].record(latency[valid])
+			else:				self.histograms[stage].record(latency, count=int(np.sum(valid)))
+		self.histograms['total'].record( (batch[self.stages[-1]] - batch['read'])[valid] )
+
+	def publish(self, frames):
+		""" a publisher of SensorPackage: the delay from the robot time stamp of the decoded /frames/ (their first channel) to now """
+		""" the robot clock is not synchronised with this one, so the delay is counted from the smallest one seen: it shows the jitter of the link """
+		""" and of the robot, not its absolute latency. if the robot restarts its clock, reset() """
+		keys = [ key for key in frames.dtype.names if key.endswith('_time') ]
+		if not keys or not len(frames): return
+		delays = time.monotonic() - frames[keys[0]].astype(np.float64)
+		with self.lock:
+			self.robot_offset = min(self.robot_offset, float(np.min(delays)))
+			self.histograms['robot'].record(delays - self.robot_offset)
+
+	def beat(self, connected):
+		pass
+
+	def reset(self):
+		with self.lock:
+			for histogram in self.histograms.values(): histogram.reset()
+			self.robot_offset = float('inf')
+
+	def summary(self):
+		""" the summary of every histogram, { stage:{ 'count', 'mean', 'p50', ... } } in seconds """
+		with self.lock: return { stage:histogram.summary() for stage, histogram in self.histograms.items() }
+
+	def report(self, file=sys.stdout):
+		""" print one line per stage, in microseconds """
+		for stage, summary in self.summary().items():
+			print( '%-9s count %8i  mean %9.1f  p50 %9.1f  p90 %9.1f  p99 %9.1f  p99.9 %9.1f  max %9.1f us' % (stage, summary['count'],
+				*[ summary[key]*1e6 for key in ('mean', 'p50', 'p90', 'p99', 'p99.9', 'max') ]), file=file )
+
+	def dump(self, filename):
+		""" write the summaries and the buckets of the histograms to /filename/ as JSON """
+		if os.path.dirname(filename): os.makedirs(os.path.dirname(filename), exist_ok=True)
+		with self.lock: data = { 'stages':list(self.stages), 'histograms':{ stage:{ **histogram.summary(), 'buckets':histogram.buckets() } for stage, histogram in self.histograms.items() } }
+		with open(filename, 'w') as f: json.dump(data, f, indent=1)